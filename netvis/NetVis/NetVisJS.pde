@@ -377,6 +377,17 @@ class App extends JSONConnection
     return def;
   }
 
+  void addPacket (jsonJSONObject msg, Node node1, Node node2)
+  {
+    double t = 1000;
+    boolean drop = msg.has("drop") ? msg.getBoolean("drop") : false;
+    if (msg.has("duration")) t = msg.getDouble("duration");
+    Packet p = new Packet(node1, node2, t, drop);
+    p.strokeColor = getColor(msg, "stroke", 0xffFFffFF);
+    p.fillColor = getColor(msg, "fill", 0);//0x7fffffff);
+    app.packets.add(p);
+  }
+
   public synchronized void process (jsonJSONObject msg)
   {
     String type = msg.getString("type","");
@@ -439,6 +450,22 @@ class App extends JSONConnection
         new Edge(node1, (int)msg.getDouble("node1_port"), node2, (int)msg.getDouble("node2_port"));
       g.running = true;
     }
+    else if (type.equals("links"))
+    {
+      // Many links at once, each [node1, node1_port, node2, node2_port]
+      jsonJSONArray links = msg.getJSONArray("links");
+      for (int i = 0; i < links.getLength(); i++)
+      {
+        jsonJSONArray l = links.getJSONArray(i);
+        node1 = getNode(l, 0);
+        node2 = getNode(l, 2);
+        if (node1 == null || node2 == null)
+          println("Asked to add bad link: " + l);
+        else
+          new Edge(node1, (int)l.getDouble(1), node2, (int)l.getDouble(3));
+      }
+      g.running = true;
+    }
     else if (type.equals("unlink"))
     {
       Edge e = g.findEdge(node1, node2);
@@ -450,13 +477,24 @@ class App extends JSONConnection
     }
     else if (type.equals("packet"))
     {
-      double t = 1000;
-      boolean drop = msg.has("drop") ? msg.getBoolean("drop") : false;
-      if (msg.has("duration")) t = msg.getDouble("duration");
-      Packet p = new Packet(node1, node2, t, drop);
-      p.strokeColor = getColor(msg, "stroke", 0xffFFffFF);
-      p.fillColor = getColor(msg, "fill", 0);//0x7fffffff);
-      app.packets.add(p);
+      addPacket(msg, node1, node2);
+    }
+    else if (type.equals("packets"))
+    {
+      // A frame's worth of packets, at most one per link and direction
+      jsonJSONArray packets = msg.getJSONArray("packets");
+      for (int i = 0; i < packets.getLength(); i++)
+      {
+        jsonJSONObject pm = packets.getJSONObject(i);
+        try
+        {
+          addPacket(pm, getNode(pm, "node1"), getNode(pm, "node2"));
+        }
+        catch (Exception e)
+        {
+          println("Bad packet: " + e);
+        }
+      }
     }
     else if (type.equals("initialize"))
     {
@@ -31,12 +31,15 @@ class RoutePacket(api.Packet):
     The latter is the destination for which this is a route advertisement.
     """
 
+    TRACE = False  # Only ever goes one hop
+    PRIORITY = 0  # Control traffic (see cable.PriorityCable)
+
     def __init__(self, destination, latency):
         super(RoutePacket, self).__init__()
         self.latency = latency
         self.destination = destination
-        self.outer_color = [1, 0, 1, 1]
-        self.inner_color = [1, 0, 1, 1]
+        self.outer_color = (1, 0, 1, 1)
+        self.inner_color = (1, 0, 1, 1)
 
     def __repr__(self):
         return "<RoutePacket to %s at cost %s>" % (self.destination, self.latency)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+Runs the DV comprehensive test over many random topologies at once
+
+Each run is a (topos.rand seed, dv_comprehensive_test seed) pair.  Runs are
+spread across a pool of worker processes, use virtual time, and have no
+remote interface, so they go as fast as the CPU allows.  Each worker runs
+simulations back to back, so the interpreter startup and imports are only
+paid once per worker.  The outcome of each run (rounds passed, the failure
+if any, and wall-clock runtime) is collected into a single JSON and/or CSV
+report.  A run only passes if it gets through all its rounds; one which
+takes longer than --timeout seconds fails.
+
+Example:
+  python dv_comprehensive_runner.py --topo-seeds=1-100 --test-seeds=1-5 \\
+    --rounds=10 --json=report.json
+"""
+
+from __future__ import print_function
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import signal
+import sys
+import time
+
+FIELDS = [
+    "topo_seed",
+    "test_seed",
+    "successes",
+    "passed",
+    "failure",
+    "sim_time",
+    "runtime",
+]
+
+
+def _seed_list(spec):
+    """
+    Parses a list of seeds such as "1-10,20,30-32"
+    """
+    seeds = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part[1:]:
+            lo, hi = part.split("-", 1)
+            seeds.extend(range(int(lo), int(hi) + 1))
+        else:
+            seeds.append(int(part))
+    return seeds
+
+
+class RunTimeout(BaseException):
+    """
+    Raised in a worker when a run goes over its time limit
+
+    It's a BaseException so that code which catches Exception (like the
+    simulator's handling of exceptions in entities) doesn't swallow it.
+    """
+
+
+_timed_out = False
+
+
+def _on_timeout(signum, frame):
+    global _timed_out
+    _timed_out = True
+    raise RunTimeout()
+
+
+def run_one(job):
+    """
+    Runs a single simulation and returns a dict describing the outcome
+
+    Each call creates a new World (and so a new sim.core.Simulation), so
+    this can be called repeatedly in the same process.
+    """
+    global _timed_out
+    topo_seed, test_seed, options = job
+    start = time.time()
+
+    timeout = options.get("timeout")
+    if not hasattr(signal, "SIGALRM"):
+        timeout = None  # run_all() still notices workers which hang
+    _timed_out = False
+    if timeout:
+        signal.signal(signal.SIGALRM, _on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        import sim.boot as boot
+
+        boot.pre_options(
+            default_switch_type=options["router"],
+            default_host_type="dv_comprehensive_test_utils.TestHost",
+            remote_interface="none",
+            interactive=False,
+            console_log=options["verbose"],
+            very_quiet=not options["verbose"],
+            headless=True,
+            debug_startup=False,
+            virtual_time=True,
+        )
+
+        modules = [
+            ("dv_comprehensive_test_utils", {}),
+            (
+                "topos.rand",
+                dict(
+                    switches=options["switches"],
+                    links=options["links"],
+                    hosts=options["hosts"],
+                    seed=topo_seed,
+                ),
+            ),
+            ("dv_comprehensive_test", dict(seed=test_seed, rounds=options["rounds"])),
+        ]
+        for name, args in modules:
+            if not boot.launch_module(name, args):
+                raise RuntimeError("Could not launch module '%s'" % (name,))
+
+        import sim.core as core
+        import dv_comprehensive_test
+
+        try:
+            core.world.start(threaded=False)
+        except (SystemExit, RunTimeout):
+            pass
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    results = dv_comprehensive_test.results
+    failure = results["failure"]
+    if _timed_out:
+        failure = "Timed out after %ss" % (timeout,)
+    elif failure is None and core.world.exception is not None:
+        failure = "Simulation ended due to exception: %r" % (core.world.exception,)
+    elif failure is None and not results["passed"]:
+        failure = "Simulation ended after %s rounds" % (results["successes"],)
+    return dict(
+        topo_seed=topo_seed,
+        test_seed=test_seed,
+        successes=results["successes"],
+        passed=results["passed"] and failure is None,
+        failure=failure,
+        sim_time=core.world.time,
+        runtime=time.time() - start,
+    )
+
+
+def _failed(job, failure):
+    topo_seed, test_seed, _ = job
+    return dict(
+        topo_seed=topo_seed,
+        test_seed=test_seed,
+        successes=0,
+        passed=False,
+        failure=failure,
+        sim_time=None,
+        runtime=None,
+    )
+
+
+def _run_guarded(job):
+    try:
+        return run_one(job)
+    except RunTimeout:
+        return _failed(job, "Timed out after %ss" % (job[2]["timeout"],))
+    except BaseException as e:
+        return _failed(job, "Run crashed: %s" % (e,))
+
+
+def run_all(
+    topo_seeds,
+    test_seeds,
+    options,
+    processes=None,
+    progress=None,
+    runs_per_process=None,
+):
+    """
+    Runs every combination of seeds and returns a list of outcomes
+
+    Up to *processes* runs happen at once.  Each worker process is
+    replaced after *runs_per_process* runs (never, if None).  If
+    *progress* is given, it's called with each outcome as it finishes.
+
+    Each worker stops a run which goes over options["timeout"] seconds.  In
+    case a worker is stuck somewhere that can't be interrupted, if no run
+    at all finishes for a while longer than that, the runs which haven't
+    finished are all counted as timed out.
+    """
+    jobs = [(a, b, options) for a, b in itertools.product(topo_seeds, test_seeds)]
+    timeout = options.get("timeout")
+    wait = timeout + 30 if timeout else None
+    pool = multiprocessing.Pool(processes, maxtasksperchild=runs_per_process)
+    outcomes = []
+    try:
+        results = pool.imap_unordered(_run_guarded, jobs)
+        for _ in jobs:
+            try:
+                outcome = results.next(wait)
+            except multiprocessing.TimeoutError:
+                done = set((o["topo_seed"], o["test_seed"]) for o in outcomes)
+                for job in jobs:
+                    if (job[0], job[1]) not in done:
+                        outcome = _failed(job, "Timed out (worker hung)")
+                        outcomes.append(outcome)
+                        if progress:
+                            progress(outcome)
+                break
+            outcomes.append(outcome)
+            if progress:
+                progress(outcome)
+    finally:
+        pool.terminate()
+        pool.join()
+    outcomes.sort(key=lambda o: (o["topo_seed"], o["test_seed"]))
+    return outcomes
+
+
+def write_json(filename, outcomes, summary):
+    with open(filename, "w") as f:
+        json.dump(dict(summary=summary, runs=outcomes), f, indent=2)
+
+
+def write_csv(filename, outcomes):
+    with open(filename, "w") as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        for outcome in outcomes:
+            writer.writerow(outcome)
+
+
+def summarize(outcomes, wall_time):
+    passed = [o for o in outcomes if o["passed"]]
+    return dict(
+        runs=len(outcomes),
+        passed=len(passed),
+        failed=len(outcomes) - len(passed),
+        rounds=sum(o["successes"] for o in outcomes),
+        wall_time=wall_time,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--topo-seeds",
+        type=_seed_list,
+        default=_seed_list("1-10"),
+        help="seeds for topos.rand, e.g. 1-10,20 (default 1-10)",
+    )
+    parser.add_argument(
+        "--test-seeds",
+        type=_seed_list,
+        default=_seed_list("43"),
+        help="seeds for dv_comprehensive_test (default 43)",
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=10,
+        help="stop a run after this many successful rounds (default 10)",
+    )
+    parser.add_argument("--switches", type=int, default=5)
+    parser.add_argument("--links", type=int, default=10)
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument(
+        "--router", default="dv_router", help="switch type (default dv_router)"
+    )
+    parser.add_argument(
+        "--processes",
+        "-j",
+        type=int,
+        default=None,
+        help="number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--runs-per-process",
+        type=int,
+        default=None,
+        help="replace each worker process after this many runs (default: never)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300,
+        help="fail a run which takes longer than this many seconds "
+        "(default 300, 0 for no limit)",
+    )
+    parser.add_argument("--json", help="write a JSON report to this file")
+    parser.add_argument("--csv", help="write a CSV report to this file")
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        action="store_true",
+        help="show simulator output from every run",
+    )
+    args = parser.parse_args()
+
+    options = dict(
+        router=args.router,
+        rounds=args.rounds,
+        switches=args.switches,
+        links=args.links,
+        hosts=args.hosts,
+        verbose=args.verbose,
+        timeout=args.timeout,
+    )
+
+    def progress(o):
+        status = "passed" if o["passed"] else str(o["failure"])
+        print(
+            "topo seed %s, test seed %s: %s rounds, %s"
+            % (o["topo_seed"], o["test_seed"], o["successes"], status)
+        )
+        sys.stdout.flush()
+
+    start = time.time()
+    outcomes = run_all(
+        args.topo_seeds,
+        args.test_seeds,
+        options,
+        args.processes,
+        progress,
+        args.runs_per_process,
+    )
+    summary = summarize(outcomes, time.time() - start)
+
+    print(
+        "%(passed)s / %(runs)s runs passed (%(rounds)s rounds) in %(wall_time).1fs"
+        % summary
+    )
+
+    if args.json:
+        write_json(args.json, outcomes, summary)
+    if args.csv:
+        write_csv(args.csv, outcomes)
+
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
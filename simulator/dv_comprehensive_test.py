@@ -15,7 +15,11 @@ import sim.api as api
 from sim.basics import Ping
 import sim.cable
 
-from dv_comprehensive_test_utils import all_hosts, all_cables
+from dv_comprehensive_test_utils import all_hosts
+
+# Outcome of the run, for dv_comprehensive_runner.  "passed" is only set
+# once all the rounds asked for have succeeded.
+results = {"successes": 0, "failure": None, "passed": False}
 
 
 def pick_action(g, rand):
@@ -39,7 +43,16 @@ def pick_action(g, rand):
     return rand.choice(actions)
 
 
-def launch(seed=None):
+def launch(seed=None, rounds=None):
+    """
+    Runs the comprehensive test
+
+    Runs until a round fails, or until *rounds* rounds have succeeded.
+    """
+    if rounds is not None:
+        rounds = int(rounds)
+    results.update(successes=0, failure=None, passed=False)
+
     # Seed the RNG.
     rand = Random()
     if seed is not None:
@@ -52,11 +65,15 @@ def launch(seed=None):
     sim.config.default_switch_type.SEND_ON_LINK_UP = True
 
     # Make sure that each cable has a transmission time of zero.
-    for c in all_cables:
+    for c in api.get_cables():
         assert c.tx_time == 0, "BUG: cable {} has non-zero transmission time {}".format(
             c, c.tx_time
         )
 
+    def fail(fmt, *args):
+        api.simlog.error(fmt, *args)
+        results["failure"] = (fmt % args).strip()
+
     def comprehensive_test_tasklet():
         """Comprehensive test."""
         successes = 0
@@ -65,9 +82,7 @@ def launch(seed=None):
             yield 0
 
             g = nx.Graph()  # Construct a graph for the current topology.
-            for c in sorted(
-                all_cables, key=lambda x: (x.src.entity.name, x.dst.entity.name)
-            ):
+            for c in api.get_cables():
                 assert c.src, "cable {} has no source".format(c)
                 assert c.dst, "cable {} has no destination".format(c)
 
@@ -133,15 +148,13 @@ def launch(seed=None):
                     rxed = dst.rxed_pings
                     for src in set(expected[dst].keys()) | set(rxed.keys()):
                         if src not in rxed:
-                            api.simlog.error(
-                                "\tFAILED: Missing ping: %s -> %s", src, dst
-                            )
+                            fail("\tFAILED: Missing ping: %s -> %s", src, dst)
                             return
 
                         assert rxed[src]
                         rx_packets = [packet for packet, _ in rxed[src]]
                         if src not in expected[dst]:
-                            api.simlog.error(
+                            fail(
                                 "\tFAILED: Extraneous ping(s): %s -> %s %s",
                                 src,
                                 dst,
@@ -150,7 +163,7 @@ def launch(seed=None):
                             return
 
                         if len(rx_packets) > 1:
-                            api.simlog.error(
+                            fail(
                                 "\tFAILED: Duplicate ping(s): %s -> %s %s",
                                 src,
                                 dst,
@@ -161,7 +174,7 @@ def launch(seed=None):
                         rx_packet = rx_packets[0]
                         assert isinstance(rx_packet, Ping)
                         if rx_packet.data != round:
-                            api.simlog.error(
+                            fail(
                                 "\tFAILED: Ping NOT from current round %d: %s -> %s %s",
                                 round,
                                 src,
@@ -173,7 +186,7 @@ def launch(seed=None):
                         _, actual_time = rxed[src][0]
                         late = actual_time - expected[dst][src]
                         if late > 0:
-                            api.simlog.error(
+                            fail(
                                 "\tFAILED: Ping late by %g sec: %s -> %s %s",
                                 actual_time - deadline[dst][src],
                                 src,
@@ -186,8 +199,12 @@ def launch(seed=None):
 
                 api.simlog.info("\tSUCCESS!")
                 successes += 1
+                results["successes"] = successes
+                if rounds is not None and successes >= rounds:
+                    results["passed"] = True
+                    return
         except Exception as e:
-            api.simlog.error("Exception occurred: %s" % e)
+            fail("Exception occurred: %s" % e)
             traceback.print_exc()
         finally:
             sys.exit()
@@ -26,6 +26,41 @@ class SimConfiguration(object):
 
     debug_startup = False
 
+    # If True, the clock jumps straight to the next event instead of
+    # following the wall clock.
+    virtual_time = False
+
+    # If True, run without any GUI: no remote interface, and the code that
+    # would generate events for it (packets, links, log records) is skipped.
+    headless = False
+
+    # If set, record the simulation to this file, or replay it from this
+    # file (up to replay_until events) -- see sim.replay.
+    record = None
+    replay = None
+    replay_until = None
+
+    # Which hops packets remember in .trace: True for all of them, False for
+    # none, or a number N for just the last N.  Packet classes can override
+    # this with their TRACE attribute.
+    packet_trace = True
+
+    # If set, each UnreliableCable which wasn't given a seed gets one made
+    # from this and the name and port it's sending from (see sim.cable).
+    cable_seed = None
+
+    # If set, profile the event loop and write the results to this file
+    # (see sim.profiler).
+    profile = None
+
+    # The TCP and web interfaces send packet animations in batches this many
+    # times a second (None/0 to send each one right away).  A batch has one
+    # animation per link and direction, standing for however many packets
+    # went that way, and at most max_animated_links of them (None or 0 for
+    # no limit).
+    packet_animation_rate = 30
+    max_animated_links = 50
+
     remote_interface = "tcp"  # Probably "tcp", "udp", or None
     remote_interface_address = "127.0.0.1"
     remote_interface_port = 4444
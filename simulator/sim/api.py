@@ -3,8 +3,8 @@ The main APIs for the simulator
 """
 
 from __future__ import print_function
+import sim
 import sim.core as core
-from random import random as rand
 
 # Non-routable packets may not really have addresses.  We just create a
 # more meaningful name for None for these cases.
@@ -169,6 +169,111 @@ def run_tasklet(_generator, *_args, **_kw):
     iterate()
 
 
+def link_many(edges, latencies=None, cable=None):
+    """
+    Links many pairs of entities at once
+
+    edges is a sequence of (a, b) pairs, and latencies is an optional
+    sequence of latencies for them.  It's like calling
+    a.linkTo(b, cable, latency=latency) for each pair, but much faster for
+    big topologies.  Returns a list of (port on a, port on b).
+    """
+    return core.link_many(edges, latencies, cable)
+
+
+def get_cables():
+    """
+    Returns a list of all the cables which are plugged in
+
+    Each one goes in one direction, from .src (port .srcPort) to .dst (port
+    .dstPort).  They're in order of their source's name and port.
+    """
+    return list(core.current.cables())
+
+
+# The counters which get_cable_stats() and get_port_stats() return arrays of
+STAT_FIELDS = (
+    "tx_packets",
+    "tx_bytes",
+    "rx_packets",
+    "rx_bytes",
+    "drops",
+    "queue_max",
+    "queue_delay",
+)
+
+
+def _stats_array(stats):
+    import numpy
+
+    keys = sorted(stats)
+    a = numpy.array(
+        [[stats[k][f] for f in STAT_FIELDS] for k in keys], dtype=float
+    ).reshape(len(keys), len(STAT_FIELDS))
+    return keys, a
+
+
+def get_cable_stats(array=False):
+    """
+    Returns the counters for every cable which is plugged in
+
+    Normally, it's a dict mapping (source name, source port, destination
+    name, destination port) to a dict of the cable's counters (see
+    Cable.stats()).
+
+    If array is True, it's a tuple of (the keys in order, a NumPy array
+    with a row for each key and a column for each of STAT_FIELDS).
+    """
+    stats = {}
+    for c in core.current.cables():
+        key = (c.srcEnt.name, c.srcPort, c.dstEnt.name, c.dstPort)
+        stats[key] = c.stats()
+    if array:
+        return _stats_array(stats)
+    return stats
+
+
+def get_port_stats(array=False):
+    """
+    Returns the counters for every port which is plugged in
+
+    Normally, it's a dict mapping (entity name, port) to a dict of counters.
+    tx_packets, tx_bytes, drops, queue_max and queue_delay are for what the
+    entity sent out of the port (i.e., the outgoing cable).  rx_packets and
+    rx_bytes are for what it received on it (the incoming cable).
+
+    If array is True, it's a tuple like for get_cable_stats().
+    """
+    stats = {}
+    for c in core.current.cables():
+        s = c.stats()
+        back = c.dst.ports[c.dstPort]
+        if back is not None and back.dst is c.src:
+            b = back.stats()
+            rx_packets, rx_bytes = b["rx_packets"], b["rx_bytes"]
+        else:
+            rx_packets, rx_bytes = 0, 0
+        stats[(c.srcEnt.name, c.srcPort)] = dict(
+            tx_packets=s["tx_packets"],
+            tx_bytes=s["tx_bytes"],
+            rx_packets=rx_packets,
+            rx_bytes=rx_bytes,
+            drops=s["drops"],
+            queue_max=s["queue_max"],
+            queue_delay=s["queue_delay"],
+            tx_by_type=s["tx_by_type"],
+        )
+    if array:
+        return _stats_array(stats)
+    return stats
+
+
+def reset_stats():
+    """Resets the counters of every cable which is plugged in"""
+    for c in core.current.cables():
+        c.reset_stats()
+
+
 def hsv_to_rgb(h, s, v, a=1):
     """
     Convert hue, saturation, value (0..1) to RGBA.
@@ -198,9 +303,49 @@ def hsv_to_rgb(h, s, v, a=1):
     return [r, g, b, a]
 
 
+class _RandomColor(object):
+    """
+    A packet color which hasn't been picked yet
+
+    Copies of a packet share one of these, so they all end up the same color.
+    """
+
+    __slots__ = ("color",)
+
+    def __init__(self):
+        self.color = None
+
+    def pick(self):
+        if self.color is None:
+            rand = core.color_rand
+            self.color = tuple(
+                hsv_to_rgb(rand(), rand() * 0.8 + 0.2, rand() * 0.5 + 0.5, 0.75)
+            )
+        return self.color
+
+
 class Packet(object):
     DEFAULT_TTL = 20
 
+    # Which hops to remember in .trace: True for all of them, False for none,
+    # or a number N for just the last N.  None uses sim.config.packet_trace.
+    TRACE = None
+
+    # Packet keeps its own fields in __slots__ so that the (many) packets in
+    # flight are quick to create.  It still has a __dict__, so you can put
+    # whatever other fields you like on a packet.  As an opt-in fast path, a
+    # subclass can list its own fields in __slots__ too; then its packets
+    # never need to allocate the __dict__ at all.
+    __slots__ = (
+        "src",
+        "dst",
+        "ttl",
+        "_trace",
+        "_outer_color",
+        "_inner_color",
+        "__dict__",
+    )
+
     def __init__(self, dst=NullAddress, src=NullAddress):
         """
         Base class for all packets
@@ -217,15 +362,72 @@ class Packet(object):
         self.src = src
         self.dst = dst
         self.ttl = self.DEFAULT_TTL  # Decremented for each entity we go through.
-        self.trace = []  # List of entities we've been sent through.  For debugging.
+        self._trace = ()  # Entities we've been sent through (see TRACE).
 
         # When using NetVis, packets are visible, and you can set the color.
         # color is a list of red, green, blue, and (optionally) alpha values.
         # Each value is between 0 and 1.  alpha of 0 is transparent.  1 is opaque.
-        self.outer_color = hsv_to_rgb(
-            rand(), rand() * 0.8 + 0.2, rand() * 0.5 + 0.5, 0.75
-        )
-        self.inner_color = [0, 0, 0, 0]  # transparent
+        # By default, outer_color is random (picked when it's first used) and
+        # inner_color is transparent.
+        self._outer_color = None
+        self._inner_color = None
+
+    # When a packet is sent, each port gets its own copy of it (see
+    # core._duplicate_packet()).  The copies share the trace and colors as
+    # tuples (see _share()), and each copy only turns them back into its own
+    # list when something actually uses them.
+    @property
+    def trace(self):
+        t = self._trace
+        if type(t) is not list:
+            t = self._trace = list(t)
+        return t
+
+    @trace.setter
+    def trace(self, value):
+        self._trace = value
+
+    @property
+    def outer_color(self):
+        c = self._outer_color
+        if type(c) is not list:
+            if c is None:
+                c = _RandomColor()
+            if type(c) is _RandomColor:
+                c = c.pick()
+            c = self._outer_color = list(c)
+        return c
+
+    @outer_color.setter
+    def outer_color(self, value):
+        self._outer_color = value
+
+    @property
+    def inner_color(self):
+        c = self._inner_color
+        if type(c) is not list:
+            c = self._inner_color = [0, 0, 0, 0] if c is None else list(c)
+        return c
+
+    @inner_color.setter
+    def inner_color(self, value):
+        self._inner_color = value
+
+    def _share(self):
+        """
+        Gets the trace and colors ready to be shared with copies
+
+        Called by the framework before copying a packet.
+        """
+        if type(self._trace) is list:
+            self._trace = tuple(self._trace)
+        c = self._outer_color
+        if c is None:
+            self._outer_color = _RandomColor()
+        elif type(c) is list:
+            self._outer_color = tuple(c)
+        if type(self._inner_color) is list:
+            self._inner_color = tuple(self._inner_color)
 
     def _notify_rx(self, srcEnt, srcPort, dstEnt, dstPort, drop):
         """
@@ -233,8 +435,25 @@ class Packet(object):
 
         Meant for internal use.
         """
-        if not drop:
-            self.trace.append(dstEnt)
+        if drop:
+            return
+        hops = self.TRACE
+        if hops is None:
+            hops = sim.config.packet_trace
+        if hops is True:
+            t = self._trace
+            if type(t) is list:
+                t.append(dstEnt)
+            else:
+                self._trace = t + (dstEnt,)
+        elif hops:
+            t = self._trace
+            if type(t) is list:
+                t.append(dstEnt)
+                if len(t) > hops:
+                    del t[:-hops]
+            else:
+                self._trace = (t + (dstEnt,))[-hops:]
 
     def _notify_tx(self, srcEnt, srcPort, dstEnt, dstPort, drop):
         """
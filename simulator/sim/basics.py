@@ -108,6 +108,8 @@ class HostDiscoveryPacket(api.Packet):
     Just a way that hosts say hello
     """
 
+    PRIORITY = 0  # Control traffic (see cable.PriorityCable)
+
     def __init__(self, *args, **kw):
         # Call original constructor
         super(HostDiscoveryPacket, self).__init__(*args, **kw)
@@ -116,12 +118,17 @@ class HostDiscoveryPacket(api.Packet):
 
 
 class RoutePacket(api.Packet):
+    __slots__ = ("latency", "destination")
+
+    TRACE = False  # Only ever goes one hop
+    PRIORITY = 0  # Control traffic (see cable.PriorityCable)
+
     def __init__(self, destination, latency):
         super(RoutePacket, self).__init__()
         self.latency = latency
         self.destination = destination
-        self.outer_color = [1, 0, 1, 1]
-        self.inner_color = [1, 0, 1, 1]
+        self.outer_color = (1, 0, 1, 1)
+        self.inner_color = (1, 0, 1, 1)
 
     def __repr__(self):
         return "<RoutePacket to %s at cost %s>" % (self.destination, self.latency)
@@ -136,6 +136,16 @@ def pre_options(
     interactive=True,
     very_quiet=False,
     readline=True,
+    virtual_time=False,
+    profile=None,
+    headless=False,
+    record=None,
+    replay=None,
+    replay_until=None,
+    packet_trace=True,
+    cable_seed=None,
+    packet_animation_rate=30,
+    max_animated_links=50,
     **kw
 ):
     """
@@ -162,6 +172,32 @@ def pre_options(
     sim.config.debug_startup = debug_startup
     sim.config.interactive = interactive
     sim.config.readline = readline
+    sim.config.virtual_time = virtual_time
+    sim.config.headless = headless
+    sim.config.record = record
+    sim.config.replay = replay
+    if replay:
+        sim.config.virtual_time = True
+    if replay_until is not None:
+        replay_until = int(replay_until)
+    sim.config.replay_until = replay_until
+    if packet_trace in ("all", "on"):
+        packet_trace = True
+    elif packet_trace == "off":
+        packet_trace = False
+    elif packet_trace is not True and packet_trace is not False:
+        packet_trace = int(packet_trace)
+    sim.config.packet_trace = packet_trace
+    sim.config.cable_seed = cable_seed
+    sim.config.packet_animation_rate = float(packet_animation_rate or 0)
+    if max_animated_links in (None, True, "none"):
+        max_animated_links = None
+    else:
+        max_animated_links = int(max_animated_links)
+    sim.config.max_animated_links = max_animated_links
+    if profile is True:
+        profile = "profile.json"
+    sim.config.profile = profile
 
     sim.config.default_host_type = default_host_type
     sim.config.default_switch_type = default_switch_type
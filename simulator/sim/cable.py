@@ -2,9 +2,35 @@
 Cables are how Entities are connected
 """
 
+from collections import deque
+import heapq
+import itertools
 import random
+
+import sim
 import sim.core as core
 
+# Default for arguments where None means something (e.g., no queue limit)
+_NOT_GIVEN = object()
+
+
+def _cable_rng(cable, seed=None):
+    """
+    Makes a random number generator for a cable which has been plugged in
+
+    See UnreliableCable for where the seed comes from if it's None.
+    """
+    if seed is None:
+        if sim.config.cable_seed is not None:
+            seed = "%s:%s:%s" % (
+                sim.config.cable_seed,
+                cable.srcEnt.name,
+                cable.srcPort,
+            )
+        else:
+            seed = int(core.rand() * 2**53)
+    return random.Random(seed)
+
 
 class Cable(object):
     """
@@ -19,6 +45,21 @@ class Cable(object):
     DEFAULT_LATENCY = 1
     latency = DEFAULT_LATENCY
 
+    DEFAULT_PACKET_SIZE = 1000  # Bytes, for packets without a .size
+
+    gui_events = True  # Tell the event interface about packets? (headless = no)
+
+    # Counters (see stats()).  reset_stats() gives each cable its own.
+    tx_packets = 0  # Packets which went onto the cable
+    tx_bytes = 0
+    rx_packets = 0  # Packets which came out the other end
+    rx_bytes = 0
+    drops = 0  # Packets which didn't (for whatever reason)
+    queue_max = 0  # The most packets which have been on the cable at once
+    queue_delay = 0.0  # Total seconds packets waited to be transmitted
+    tx_by_type = None  # Packet type -> packets which went onto the cable
+    _stats_since = None
+
     def initialize(self, src, srcport, dst, dstport):
         """Called to set up the ends."""
         for a in ["src", "srcPort", "srcEntity", "dst", "dstPort", "dstEntity"]:
@@ -29,6 +70,62 @@ class Cable(object):
         self.dst = dst
         self.dstPort = dstport
         self.dstEnt = dst.entity
+        self.gui_events = core.world.gui_events
+        self.reset_stats()
+
+    def packet_size(self, packet):
+        return getattr(packet, "size", None) or self.DEFAULT_PACKET_SIZE
+
+    def reset_stats(self):
+        self.tx_packets = 0
+        self.tx_bytes = 0
+        self.rx_packets = 0
+        self.rx_bytes = 0
+        self.drops = 0
+        self.queue_max = 0
+        self.queue_delay = 0.0
+        self.tx_by_type = {}
+        self._stats_since = core.world.time
+
+    def _count_tx(self, packet):
+        self.tx_packets += 1
+        self.tx_bytes += self.packet_size(packet)
+        t = type(packet)
+        by_type = self.tx_by_type
+        by_type[t] = by_type.get(t, 0) + 1
+
+    def _count_rx(self, packet):
+        self.rx_packets += 1
+        self.rx_bytes += self.packet_size(packet)
+
+    def stats(self):
+        """
+        Returns the counters as a dict
+
+        Also includes throughput (bits per second which went onto the cable
+        since the counters were reset) and the mean time packets waited to
+        be transmitted.  tx_by_type is keyed by packet type name.
+        """
+        elapsed = 0
+        if self._stats_since is not None:
+            elapsed = core.world.time - self._stats_since
+        by_type = {}
+        for t, n in (self.tx_by_type or {}).items():
+            by_type[t.__name__] = by_type.get(t.__name__, 0) + n
+        return dict(
+            tx_packets=self.tx_packets,
+            tx_bytes=self.tx_bytes,
+            rx_packets=self.rx_packets,
+            rx_bytes=self.rx_bytes,
+            drops=self.drops,
+            queue_max=self.queue_max,
+            queue_delay=self.queue_delay,
+            tx_by_type=by_type,
+            throughput=self.tx_bytes * 8.0 / elapsed if elapsed > 0 else 0.0,
+            mean_queue_delay=(
+                self.queue_delay / self.tx_packets if self.tx_packets else 0.0
+            ),
+        )
 
     def transfer(self, packet):
         """Implement this in subclasses."""
@@ -59,12 +156,15 @@ class DumbCable(Cable):
             packet._notify_rx(
                 self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False
             )
+            self._count_rx(packet)
 
             self.dstEnt.handle_rx(packet, self.dstPort)
 
         core.world.doLater(self.latency, rx)
+        self._count_tx(packet)
 
-        core.events.packet(self.srcEnt.name, self.dstEnt.name, packet, self.latency)
+        if self.gui_events:
+            core.events.packet(self.srcEnt.name, self.dstEnt.name, packet, self.latency)
         packet._notify_tx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False)
 
 
@@ -80,10 +180,23 @@ class BasicCable(DumbCable):
     DEFAULT_QUEUE_SIZE = None  # Unlimited
     DEFAULT_TX_TIME = 0.1  # Transmission delay
 
+    CHECK_QUEUE = False  # Sanity check the queue on every change (slow!)
+
     def __init__(self, *args, **kw):
         self.size = kw.pop("queue_size", self.DEFAULT_QUEUE_SIZE)
-        self.queue = []  # time, packet
+
+        # The queue holds (delivery time, sequence number, packet).  Packets
+        # almost always arrive in the order they're to be delivered, so it's
+        # usually just a deque.  If one ever has to go before the end (e.g.,
+        # because the latency was lowered), it becomes a heap until it empties.
+        self.queue = deque()
+        self._fifo = True
+        self._seq = itertools.count()
+
+        # There's at most one deliver() scheduled per cable, for the time the
+        # packet at the head of the queue is due.
         self.next_delivery = None
+        self._delivery_event = None
 
         super(BasicCable, self).__init__(*args, **kw)
 
@@ -92,20 +205,55 @@ class BasicCable(DumbCable):
         self._tx_stop = None  # Time at which current transfer ends (or None)
 
     def drop(self):
-        del self.queue[-1]  # Tail drop
+        # Tail drop (i.e., the packet which was just queued)
+        if self._fifo:
+            self.queue.pop()
+        else:
+            q = self.queue
+            q.remove(max(q, key=self._queue_seq))
+            heapq.heapify(q)
+
+    def _enqueue(self, t, packet):
+        q = self.queue
+        entry = (t, next(self._seq), packet)
+        if not self._fifo:
+            heapq.heappush(q, entry)
+        elif q and t < q[-1][0]:
+            # Out of order.  A sorted list is already a heap.
+            q = self.queue = list(q)
+            self._fifo = False
+            heapq.heappush(q, entry)
+        else:
+            q.append(entry)
+
+    def _dequeue(self):
+        if self._fifo:
+            return self.queue.popleft()
+        q = self.queue
+        entry = heapq.heappop(q)
+        if not q:
+            self.queue = deque()
+            self._fifo = True
+        return entry
+
+    def _check_queue(self):
+        q = self.queue
+        if self._fifo:
+            assert all(q[i][0] <= q[i + 1][0] for i in range(len(q) - 1))
+        else:
+            assert all(q[(i - 1) // 2] <= q[i] for i in range(1, len(q)))
 
     def sched(self):
         if not self.queue:
             return
-        assert [x[0] for x in self.queue] == [
-            x[0] for x in sorted(self.queue, key=self._queue_key)
-        ]
-        # self.queue.sort() # We could do better than this! (And have, apparently)
+        if self.CHECK_QUEUE:
+            self._check_queue()
         t = self.queue[0][0]
-        self.next_delivery = None
         if self.next_delivery is None or t < self.next_delivery:
+            if self._delivery_event is not None:
+                self._delivery_event.cancel()
             self.next_delivery = t
-            core.world.doAt(t, self.deliver)
+            self._delivery_event = core.world.doAt(t, self.deliver)
 
     def deliver(self):
         if self.src:
@@ -113,6 +261,7 @@ class BasicCable(DumbCable):
         if self.dst:
             self.old_dst = self.dst
         self.next_delivery = None
+        self._delivery_event = None
         drop = False
         if not self.src or self.src.ports[self.srcPort] is not self:
             if self.queue:
@@ -120,16 +269,18 @@ class BasicCable(DumbCable):
                 drop = True
                 return
 
+        now = core.world.time
         while self.queue:
-            if self.queue[0][0] > core.world.time:
+            if self.queue[0][0] > now:
                 break
-            p = self.queue.pop(0)[1]
+            p = self._dequeue()[2]
             self._do_deliver(p, drop)
         self.sched()
 
     def _do_deliver(self, p, drop):
         p._notify_rx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, drop)
         if not drop:
+            self._count_rx(p)
             self.dstEnt.handle_rx(p, self.dstPort)
 
     def transfer(self, packet):
@@ -144,33 +295,51 @@ class BasicCable(DumbCable):
             tx_at = self._tx_stop
             self._tx_stop += tx_time
 
-        self.queue.append((tx_at + tx_time + self.latency, packet))
+        self._enqueue(tx_at + tx_time + self.latency, packet)
         if self.size is not None and len(self.queue) > self.size:
             self.drop()
-
-        if len(self.queue) >= 2:
-            if self.queue[-1][0] < self.queue[-2][0]:
-                # Deliver last before second-to-last?
-                # Simple answer: just sort
-                self.queue.sort(key=self._queue_key)
+            self.drops += 1
+        else:
+            self._count_tx(packet)
+            self.queue_delay += tx_at - now
+            if len(self.queue) > self.queue_max:
+                self.queue_max = len(self.queue)
 
         self.sched()
 
-        core.events.packet(self.srcEnt.name, self.dstEnt.name, packet, self.latency)
+        if self.gui_events:
+            core.events.packet(self.srcEnt.name, self.dstEnt.name, packet, self.latency)
 
         packet._notify_tx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False)
 
     def _handle_disconnect(self):
-        del self.queue[:]
+        self.drops += len(self.queue)  # Packets which were on the wire
+        self.queue = deque()
+        self._fifo = True
 
     @staticmethod
     def _queue_key(queue_item):
         return queue_item[0]
 
+    @staticmethod
+    def _queue_seq(queue_item):
+        return queue_item[1]
+
 
 class UnreliableCable(BasicCable):
     """
     Very much like its superclass except it drops packets sometimes.
+
+    Each one has its own random number generator for deciding which packets
+    to drop, so how many packets go over other links (or what color they
+    are) doesn't change which ones get dropped on this one.  It's seeded
+    when the cable is plugged in, with the first of these there is:
+     * the seed passed in
+     * sim.config.cable_seed combined with the source's name and port (so
+       a given link drops the same packets every time, even if links are
+       added elsewhere)
+     * a number from the Simulation's core.rand() (so it's the same when
+       a recording is replayed)
     """
 
     @classmethod
@@ -188,19 +357,411 @@ class UnreliableCable(BasicCable):
             cls(latency=latency, drop=drop_reverse),
         )
 
-    def __init__(self, latency=None, drop=0.1):
+    def __init__(self, latency=None, drop=0.1, seed=None):
         """
         Drop 10% by default
         """
         super(UnreliableCable, self).__init__(latency=latency)
         self.drop_rate = drop
+        self.seed = seed
+        self.rng = None
+
+    def initialize(self, src, srcport, dst, dstport):
+        super(UnreliableCable, self).initialize(src, srcport, dst, dstport)
+        self.rng = _cable_rng(self, self.seed)
+        self._random = self.rng.random
 
     def transfer(self, packet):
         # It'd be nice if we called notify_tx and not notify_rx for dropped packets
         # or something, but that'd require more work. :)
-        if random.random() >= self.drop_rate:
+        if self._random() >= self.drop_rate:
             super(UnreliableCable, self).transfer(packet)
-        else:
+            return
+        self.drops += 1
+        if self.gui_events:
             core.events.packet(
                 self.srcEnt.name, self.dstEnt.name, packet, self.latency, drop=True
             )
+
+
+class QueuedCable(BasicCable):
+    """
+    A cable with a bandwidth and a transmit queue
+
+    Unlike with BasicCable (where every packet takes tx_time to send), a
+    packet takes its size in bits divided by the bandwidth to send.  Packets
+    which show up while the cable is busy wait in a queue of up to
+    queue_size packets (more are dropped; None for no limit).  Once a packet
+    has been sent, it arrives latency seconds later.
+
+    A packet's size is its .size (in bytes) if it has one, and
+    DEFAULT_PACKET_SIZE if it doesn't.
+
+    This one's queue is a plain FIFO.  Subclasses can change which packets
+    get in (admit()), the order they wait in (_push() and friends), and
+    when the next one can go (ready()).
+
+    For this kind of cable, the counters (see Cable) count a packet as
+    going onto the cable when it's sent (rather than when it's queued),
+    queue_max is the most packets which have been waiting in the queue,
+    and stats() also includes queue_len.
+    """
+
+    DEFAULT_BANDWIDTH = 10e6  # Bits per second
+    DEFAULT_QUEUE_SIZE = 100  # Packets
+
+    def __init__(self, latency=None, bandwidth=None, queue_size=_NOT_GIVEN):
+        if queue_size is _NOT_GIVEN:
+            queue_size = self.DEFAULT_QUEUE_SIZE
+        super(QueuedCable, self).__init__(latency=latency, queue_size=queue_size)
+        self.bandwidth = bandwidth or self.DEFAULT_BANDWIDTH
+        self._init_queue()
+        self._sending = None  # Event for when we can send the next packet
+
+    # The transmit queue, which holds (arrival time, packet)
+    def _init_queue(self):
+        self._waiting = deque()
+
+    def _queue_len(self):
+        return len(self._waiting)
+
+    def _is_full(self, packet):
+        return self.size is not None and len(self._waiting) >= self.size
+
+    def _push(self, entry):
+        self._waiting.append(entry)
+
+    def _peek(self):
+        return self._waiting[0]
+
+    def _pop(self):
+        return self._waiting.popleft()
+
+    def admit(self, packet):
+        """Returns whether packet gets into the queue (if there's room)"""
+        return True
+
+    def ready(self, packet, size):
+        """
+        Returns how long to wait before packet can be sent
+
+        Called with the packet at the head of the queue when the cable is
+        free.  0 means it can go now.
+        """
+        return 0
+
+    def _drop_packet(self, packet):
+        if self.gui_events:
+            core.events.packet(
+                self.srcEnt.name, self.dstEnt.name, packet, self.latency, drop=True
+            )
+
+    def transfer(self, packet):
+        if not self.admit(packet) or self._is_full(packet):
+            self.drops += 1
+            self._drop_packet(packet)
+            return
+        self._push((core.world.time, packet))
+        n = self._queue_len()
+        if n > self.queue_max:
+            self.queue_max = n
+        if self._sending is None:
+            self._send_next()
+
+    def _send_next(self):
+        self._sending = None
+        if not self._queue_len():
+            return
+        arrived, packet = self._peek()
+        size = self.packet_size(packet)
+        wait = self.ready(packet, size)
+        if wait > 0:
+            self._sending = core.world.doLater(wait, self._send_next)
+            return
+        self._pop()
+
+        now = core.world.time
+        tx_time = size * 8.0 / self.bandwidth
+        self._count_tx(packet)
+        self.queue_delay += now - arrived
+        self._enqueue(now + tx_time + self.latency, packet)
+        self.sched()
+        self._sending = core.world.doLater(tx_time, self._send_next)
+
+        if self.gui_events:
+            core.events.packet(
+                self.srcEnt.name, self.dstEnt.name, packet, tx_time + self.latency
+            )
+        packet._notify_tx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False)
+
+    def _handle_disconnect(self):
+        super(QueuedCable, self)._handle_disconnect()
+        self.drops += self._queue_len()
+        self._init_queue()
+        if self._sending is not None:
+            self._sending.cancel()
+            self._sending = None
+
+    def stats(self):
+        s = super(QueuedCable, self).stats()
+        s.update(queue_len=self._queue_len())
+        return s
+
+
+class REDCable(QueuedCable):
+    """
+    A QueuedCable which does Random Early Detection
+
+    It keeps a moving average of the queue length.  Below min_threshold,
+    everything gets in.  Above max_threshold, nothing does.  In between,
+    packets are dropped with a probability which rises to max_p (and which
+    is spread out by how many packets got in since the last drop, as in
+    the original RED paper).
+
+    If ecn is True, packets which have a true .ecn_capable are marked (by
+    setting their .ecn_marked to True) instead of being dropped early.
+
+    Like UnreliableCable, each one has its own random number generator
+    (seeded the same way), so its early drops don't change the random
+    numbers anything else gets.
+
+    Extra counters: early_drops (which are also counted in drops) and marks.
+    """
+
+    DEFAULT_MIN_THRESHOLD = 5  # Packets
+    DEFAULT_MAX_THRESHOLD = 15  # Packets
+    DEFAULT_MAX_P = 0.1
+    DEFAULT_WEIGHT = 0.002  # For the moving average
+
+    def __init__(
+        self,
+        latency=None,
+        bandwidth=None,
+        queue_size=_NOT_GIVEN,
+        min_threshold=None,
+        max_threshold=None,
+        max_p=None,
+        weight=None,
+        ecn=False,
+        seed=None,
+    ):
+        super(REDCable, self).__init__(
+            latency=latency, bandwidth=bandwidth, queue_size=queue_size
+        )
+        if min_threshold is None:
+            min_threshold = self.DEFAULT_MIN_THRESHOLD
+        if max_threshold is None:
+            max_threshold = self.DEFAULT_MAX_THRESHOLD
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.max_p = self.DEFAULT_MAX_P if max_p is None else max_p
+        self.weight = weight or self.DEFAULT_WEIGHT
+        self.ecn = ecn
+        self.seed = seed
+        self.rng = None
+
+        self.average = 0.0
+        self._count = -1  # Packets since the last early drop
+        self._idle_since = core.world.time
+
+    early_drops = 0
+    marks = 0
+
+    def initialize(self, src, srcport, dst, dstport):
+        super(REDCable, self).initialize(src, srcport, dst, dstport)
+        self.rng = _cable_rng(self, self.seed)
+        self._random = self.rng.random
+
+    def reset_stats(self):
+        super(REDCable, self).reset_stats()
+        self.early_drops = 0
+        self.marks = 0
+
+    def _update_average(self):
+        q = self._queue_len()
+        if q == 0 and self._sending is None and self._idle_since is not None:
+            # The queue has been empty for a while.  Decay the average as if
+            # small packets had been going through the whole time.
+            idle = core.world.time - self._idle_since
+            m = idle * self.bandwidth / (8.0 * self.DEFAULT_PACKET_SIZE)
+            self.average *= (1 - self.weight) ** m
+        else:
+            self.average += self.weight * (q - self.average)
+        return self.average
+
+    def admit(self, packet):
+        avg = self._update_average()
+        self._idle_since = None
+        if avg < self.min_threshold:
+            self._count = -1
+            return True
+        self._count += 1
+        if avg >= self.max_threshold:
+            p = 1.0
+        else:
+            pb = (
+                self.max_p
+                * (avg - self.min_threshold)
+                / (self.max_threshold - self.min_threshold)
+            )
+            p = pb / (1 - self._count * pb) if self._count * pb < 1 else 1.0
+        if self._random() >= p:
+            return True
+        self._count = 0
+        if self.ecn and getattr(packet, "ecn_capable", False):
+            packet.ecn_marked = True
+            self.marks += 1
+            return True
+        self.early_drops += 1
+        return False
+
+    def _send_next(self):
+        super(REDCable, self)._send_next()
+        if self._sending is None:
+            self._idle_since = core.world.time
+
+    def stats(self):
+        s = super(REDCable, self).stats()
+        s.update(early_drops=self.early_drops, marks=self.marks, average=self.average)
+        return s
+
+
+class PriorityCable(QueuedCable):
+    """
+    A QueuedCable with strict priority classes
+
+    Each class has its own queue of up to queue_size packets, and a packet
+    is only sent when every higher class's queue is empty.  A packet's class
+    is its .PRIORITY (0 is the highest) if it has one, and DEFAULT_PRIORITY
+    if not.  Routing control traffic (e.g., RoutePacket) has a PRIORITY of
+    0, so it isn't starved by data.
+
+    Extra counters: tx_packets_by_class and drops_by_class (lists).
+    """
+
+    DEFAULT_LEVELS = 2
+    DEFAULT_PRIORITY = 1
+
+    def __init__(
+        self, latency=None, bandwidth=None, queue_size=_NOT_GIVEN, levels=None
+    ):
+        self.levels = levels or self.DEFAULT_LEVELS
+        super(PriorityCable, self).__init__(
+            latency=latency, bandwidth=bandwidth, queue_size=queue_size
+        )
+        self.reset_stats()
+
+    def reset_stats(self):
+        super(PriorityCable, self).reset_stats()
+        self.tx_packets_by_class = [0] * self.levels
+        self.drops_by_class = [0] * self.levels
+
+    def priority(self, packet):
+        p = getattr(packet, "PRIORITY", self.DEFAULT_PRIORITY)
+        return min(max(p, 0), self.levels - 1)
+
+    def _init_queue(self):
+        self._waiting = [deque() for _ in range(self.levels)]
+        self._waiting_count = 0
+
+    def _queue_len(self):
+        return self._waiting_count
+
+    def _is_full(self, packet):
+        level = self.priority(packet)
+        return self.size is not None and len(self._waiting[level]) >= self.size
+
+    def _drop_packet(self, packet):
+        self.drops_by_class[self.priority(packet)] += 1
+        super(PriorityCable, self)._drop_packet(packet)
+
+    def _push(self, entry):
+        self._waiting[self.priority(entry[1])].append(entry)
+        self._waiting_count += 1
+
+    def _head(self):
+        for q in self._waiting:
+            if q:
+                return q
+        raise IndexError("queue is empty")
+
+    def _peek(self):
+        return self._head()[0]
+
+    def _pop(self):
+        entry = self._head().popleft()
+        self._waiting_count -= 1
+        self.tx_packets_by_class[self.priority(entry[1])] += 1
+        return entry
+
+    def stats(self):
+        s = super(PriorityCable, self).stats()
+        s.update(
+            tx_packets_by_class=list(self.tx_packets_by_class),
+            drops_by_class=list(self.drops_by_class),
+        )
+        return s
+
+
+class TokenBucketCable(QueuedCable):
+    """
+    A QueuedCable which is shaped by a token bucket
+
+    Tokens (bytes) go into the bucket at rate bits per second, and it holds
+    up to burst bytes.  A packet can only be sent when there are enough
+    tokens for it, which it uses up.  So over time the cable sends no faster
+    than rate, but it can send up to burst bytes at its full bandwidth.
+
+    Extra counter: shaped (packets which had to wait for tokens).
+    """
+
+    DEFAULT_RATE = 1e6  # Bits per second
+    DEFAULT_BURST = 10000  # Bytes
+    EPSILON = 1e-6  # Close enough (so rounding doesn't leave us waiting forever)
+
+    def __init__(
+        self,
+        latency=None,
+        bandwidth=None,
+        queue_size=_NOT_GIVEN,
+        rate=None,
+        burst=None,
+    ):
+        super(TokenBucketCable, self).__init__(
+            latency=latency, bandwidth=bandwidth, queue_size=queue_size
+        )
+        self.rate = rate or self.DEFAULT_RATE
+        self.burst = burst or self.DEFAULT_BURST
+        self.tokens = float(self.burst)
+        self._filled_at = core.world.time
+        self._shaping = None  # Packet we're waiting for tokens for
+
+    shaped = 0
+
+    def reset_stats(self):
+        super(TokenBucketCable, self).reset_stats()
+        self.shaped = 0
+
+    def _refill(self):
+        now = core.world.time
+        self.tokens = min(
+            self.burst, self.tokens + (now - self._filled_at) * self.rate / 8.0
+        )
+        self._filled_at = now
+
+    def ready(self, packet, size):
+        self._refill()
+        size = min(size, self.burst)  # Else it'd never go
+        if self.tokens >= size - self.EPSILON:
+            self.tokens = max(self.tokens - size, 0.0)
+            self._shaping = None
+            return 0
+        if self._shaping is not packet:
+            self._shaping = packet
+            self.shaped += 1
+        return (size - self.tokens) * 8.0 / self.rate
+
+    def stats(self):
+        s = super(TokenBucketCable, self).stats()
+        s.update(shaped=self.shaped, tokens=self.tokens)
+        return s
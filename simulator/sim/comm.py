@@ -25,6 +25,11 @@ class NullInterface(object):
     def send_link_up(self, srcid, sport, dstid, dport):
         pass
 
+    def send_links_up(self, links):
+        """links is a list of (srcid, sport, dstid, dport)"""
+        for link in links:
+            self.send_link_up(*link)
+
     def send_info(self, msg):
         pass
 
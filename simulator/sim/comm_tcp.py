@@ -8,62 +8,271 @@ import sim.comm as comm
 import socket
 import json
 import threading
+import time
 import traceback
+from collections import deque
 
 import sim.core as core
 
+_NOT_GIVEN = object()  # Default argument when None means something
+
+
+class Writer(object):
+    """
+    Writes to a connection from its own thread
+
+    The simulation thread just queues up data with put(), so it never waits
+    on a slow connection.  Whatever has piled up by the time the thread gets
+    to it goes out in a single write.
+
+    If a connection falls MAX_QUEUE writes behind, new droppable ones (i.e.,
+    packet animations) are thrown away until it catches up.  Others (links
+    coming and going and such) are always kept, since the GUI would be wrong
+    without them.
+    """
+
+    MAX_QUEUE = 1000
+
+    def __init__(self, write, on_error):
+        """
+        write is called with bytes to write, and should raise on failure
+        on_error is called (with no arguments) if it does
+        """
+        self._write = write
+        self._on_error = on_error
+        self._queue = deque()
+        self._held = None
+        self._cv = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._writeLoop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, data, droppable=False):
+        with self._cv:
+            if self._closed:
+                return
+            if self._held is not None:
+                if droppable:
+                    self.dropped += 1
+                else:
+                    self._held.append(data)
+                return
+            q = self._queue
+            if droppable and len(q) >= self.MAX_QUEUE:
+                self.dropped += 1
+                return
+            q.append(data)
+            if len(q) == 1:
+                self._cv.notify()
+
+    def hold(self):
+        """
+        Holds back what's put() from now on until release()
+
+        Droppable writes are dropped instead of being held.
+        """
+        with self._cv:
+            self._held = []
+
+    def release(self, first=()):
+        """Queues up first, and then everything which was held back"""
+        with self._cv:
+            held = self._held or []
+            self._held = None
+            if self._closed:
+                return
+            q = self._queue
+            q.extend(first)
+            q.extend(held)
+            if q:
+                self._cv.notify()
+
+    def close(self):
+        with self._cv:
+            self._closed = True
+            self._queue.clear()
+            self._cv.notify()
+
+    def _writeLoop(self):
+        while True:
+            with self._cv:
+                while not self._queue and not self._closed:
+                    self._cv.wait()
+                if self._closed:
+                    return
+                data = b"".join(self._queue)
+                self._queue.clear()
+            try:
+                self._write(data)
+            except Exception:
+                self.close()
+                self._on_error()
+                return
+
+
+class PacketBatcher(object):
+    """
+    Batches up packet animations for an interface
+
+    Animating every packet would be far more than NetVis can draw when
+    there's lots of traffic.  So instead, packets are counted up per link
+    (and direction, and whether they were dropped) for 1/rate seconds, and
+    then sent in a single "packets" message with one entry per link.  NetVis
+    draws one animation per entry.  Each entry has the number of packets it
+    stands for, and the colors of the first of them.
+
+    max_links caps the number of entries (i.e., links) in a batch, not the
+    number of packets: however busy a link is, it's a single entry.  Once a
+    batch is full, packets on links which aren't already in it are left
+    out (and counted in .dropped).  By default it's the max_animated_links
+    config option; None or 0 means there's no limit.
+
+    The batches are put together and sent from the batcher's own thread.
+    """
+
+    def __init__(self, interface, rate=None, max_links=_NOT_GIVEN):
+        if rate is None:
+            rate = sim.config.packet_animation_rate
+        if max_links is _NOT_GIVEN:
+            max_links = sim.config.max_animated_links
+        if not max_links:
+            max_links = None
+        elif max_links < 0:
+            raise ValueError("max_links must be positive (or None for no limit)")
+        self.interface = interface
+        self.interval = 1.0 / rate
+        self.max_links = max_links
+        self.dropped = 0
+        self._batch = {}  # (n1, n2, drop) -> entry
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self.thread = threading.Thread(target=self._sendLoop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, n1, n2, packet, duration, drop=False):
+        key = (n1, n2, drop)
+        with self._lock:
+            batch = self._batch
+            entry = batch.get(key)
+            if entry is not None:
+                entry["count"] += 1
+                return
+            if self.max_links is not None and len(batch) >= self.max_links:
+                self.dropped += 1
+                return
+            batch[key] = {
+                "node1": n1,
+                "node2": n2,
+                "duration": duration * 1000,
+                "stroke": packet.outer_color,
+                "fill": packet.inner_color,
+                "drop": drop,
+                "count": 1,
+            }
+            if len(batch) == 1:
+                self._pending.set()
+
+    def _sendLoop(self):
+        while True:
+            self._pending.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                batch = self._batch
+                self._batch = {}
+                self._pending.clear()
+            try:
+                self.interface.send(
+                    {"type": "packets", "packets": list(batch.values())},
+                    droppable=True,
+                )
+            except Exception:
+                traceback.print_exc()
+
+
+class TopologyIndex(object):
+    """
+    The topology, as far as what's been sent to the GUI goes
+
+    The interfaces keep one of these up to date as they send entities and
+    links coming and going, so that a new connection can start from a copy
+    of it (see StreamingConnection._send_initialize()).
+    """
+
+    def __init__(self):
+        self.entities = {}  # name -> NetVis kind ("square" or "circle")
+        self.links = {}  # (name1, port1, name2, port2) -> None, in order
+
+    @staticmethod
+    def _key(a, A, b, B):
+        if a <= b:
+            return (a, A, b, B)
+        return (b, B, a, A)
+
+    def entity_up(self, name, kind):
+        self.entities[name] = kind
+
+    def entity_down(self, name):
+        self.entities.pop(name, None)
+
+    def link_up(self, a, A, b, B):
+        self.links[self._key(a, A, b, B)] = None
+
+    def link_down(self, a, A, b, B):
+        self.links.pop(self._key(a, A, b, B), None)
+
 
 class StreamingConnection(comm.NullInterface):
     READ_TIMEOUT = 5
 
+    # When sending the topology to a new connection, send this many links
+    # per message
+    INITIALIZE_CHUNK = 1000
+
+    encoding = "json"  # How the interface should encode messages for us
+
     def __init__(self, parent, sock):
         self.sock = sock
         self.parent = parent
+        self._writer = Writer(sock.sendall, self._write_failed)
         self.thread = threading.Thread(target=self._recvLoop)
         self.thread.daemon = True
         self.thread.start()
         self._send_initialize()
 
     def _send_initialize(self):
+        """
+        Adds this connection to the interface and sends it the topology
+
+        The topology comes from a copy of the interface's TopologyIndex,
+        taken at the same moment this connection starts getting the
+        messages the interface sends.  Those are held back until the
+        topology has been queued up, so nothing is missed or sent twice.
+        It's encoded here (not in the simulation thread), and the links
+        are sent INITIALIZE_CHUNK at a time.
+        """
         parent = self.parent
-
-        def make(a, A, b, B):
-            a = a.entity.name
-            b = b.entity.name
-            if a <= b:
-                return (a, A, b, B)
-            return (b, B, a, A)
-
-        links = set()
-        for te in core.topo.values():
-            for n, p in enumerate(te.ports):
-                if p is None:
-                    continue
-                links.add(make(te, n, p.dst, p.dstPort))
-        links = [list(e) for e in links]
-
-        import sim.api
-
-        msg = {
-            "type": "initialize",
-            "entities": dict(
-                [
-                    (
-                        n.entity.name,
-                        "circle"
-                        if isinstance(n.entity, sim.api.HostEntity)
-                        else "square",
-                    )
-                    for n in core.topo.values()
-                ]
-            ),
-            #      'entities': {},
-            "links": links,
-        }
-        parent.send(msg, connections=self)
-        if core.world.info:
-            msg = {"type": "info", "text": core.world.info}
-            parent.send(msg, connections=self)
+        with parent.topology_lock:
+            self._writer.hold()
+            parent.connections.append(self)
+            entities = dict(parent.topology.entities)
+            links = list(parent.topology.links)
+            info = core.world.info
+
+        def encode(msg):
+            return parent._encode(msg, self.encoding)
+
+        chunk = self.INITIALIZE_CHUNK
+        out = [
+            encode({"type": "initialize", "entities": entities, "links": links[:chunk]})
+        ]
+        for i in range(chunk, len(links), chunk):
+            out.append(encode({"type": "links", "links": links[i : i + chunk]}))
+        if info:
+            out.append(encode({"type": "info", "text": info}))
+        self._writer.release(out)
 
     def _recvLoop(self):
         import select
@@ -152,18 +361,18 @@ class StreamingConnection(comm.NullInterface):
             node.disconnect()
 
     def send_raw(self, msg):
-        try:
-            self.sock.send(msg.encode())
-        except Exception:
-            try:
-                self.sock.close()
-            except Exception:
-                pass
-            self.sock = None
-            # TODO: reopen?
-            pass
+        self._writer.put(msg.encode())
+
+    def send_encoded(self, data, droppable=False):
+        """Sends a message which the interface has already encoded"""
+        self._writer.put(data, droppable)
+
+    def _write_failed(self):
+        # TODO: reopen?
+        self.parent._disconnect(self)
 
     def _close(self):
+        self._writer.close()
         self.sock.close()
 
 
@@ -172,6 +381,11 @@ class StreamingInterface(object):
 
     def __init__(self):
         self.connections = []
+        self.topology = TopologyIndex()
+        self.topology_lock = threading.Lock()
+        self._packets = None
+        if sim.config.packet_animation_rate:
+            self._packets = PacketBatcher(self)
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -193,7 +407,8 @@ class StreamingInterface(object):
                     break
                 sock, addr = self.sock.accept()
                 # print "connect",addr
-                self.connections.append(self.CONNECTION_CLASS(self, sock))
+                # (It adds itself to self.connections)
+                self.CONNECTION_CLASS(self, sock)
         except Exception:
             traceback.print_exc()
             pass
@@ -210,16 +425,32 @@ class StreamingInterface(object):
         except Exception:
             pass
 
-    def send(self, msg, connections=None):
+    def _encode(self, msg, encoding):
+        """Turns a message into the bytes which go over the wire"""
+        return (json.dumps(msg, default=repr) + "\n").encode()
+
+    def send(self, msg, connections=None, droppable=False):
+        """
+        Sends a message to all the connections (or just the ones given)
+
+        The message is encoded just once for each encoding the connections
+        use, however many connections there are.
+        If droppable, slow connections may not get it (see Writer).
+        """
         if connections is None:
-            connections = self.connections
+            connections = list(self.connections)
         elif not isinstance(connections, list):
             connections = [connections]
-        r = json.dumps(msg, default=repr) + "\n"
+        if not connections:
+            return
+        encoded = {}
         bad = []
         for c in connections:
             try:
-                c.send_raw(r)
+                data = encoded.get(c.encoding)
+                if data is None:
+                    data = encoded[c.encoding] = self._encode(msg, c.encoding)
+                c.send_encoded(data, droppable)
             except Exception:
                 bad.append(c)
         for c in bad:
@@ -239,35 +470,56 @@ class StreamingInterface(object):
     def send_log(self, record):
         self.send(record)
 
+    # The topology messages go out with topology_lock held (see
+    # StreamingConnection._send_initialize()).
+
     def send_entity_down(self, name):
-        self.send(
-            {
-                "type": "delEntity",
-                "node": name,
-            }
-        )
+        with self.topology_lock:
+            self.topology.entity_down(name)
+            self.send(
+                {
+                    "type": "delEntity",
+                    "node": name,
+                }
+            )
 
     def send_entity_up(self, name, kind):
-        self.send(
-            {
-                "type": "addEntity",
-                "kind": "square" if kind == "switch" else "circle",
-                "label": name,
-            }
-        )
+        kind = "square" if kind == "switch" else "circle"
+        with self.topology_lock:
+            self.topology.entity_up(name, kind)
+            self.send(
+                {
+                    "type": "addEntity",
+                    "kind": kind,
+                    "label": name,
+                }
+            )
 
     def send_link_up(self, srcid, sport, dstid, dport):
-        self.send(
-            {
-                "type": "link",
-                "node1": srcid,
-                "node2": dstid,
-                "node1_port": sport,
-                "node2_port": dport,
-            }
-        )
+        with self.topology_lock:
+            self.topology.link_up(srcid, sport, dstid, dport)
+            self.send(
+                {
+                    "type": "link",
+                    "node1": srcid,
+                    "node2": dstid,
+                    "node1_port": sport,
+                    "node2_port": dport,
+                }
+            )
+
+    def send_links_up(self, links):
+        with self.topology_lock:
+            for link in links:
+                self.topology.link_up(*link)
+            self.send({"type": "links", "links": [list(l) for l in links]})
 
     def packet(self, n1, n2, packet, duration, drop=False):
+        if not self.connections:
+            return
+        if self._packets is not None:
+            self._packets.add(n1, n2, packet, duration, drop)
+            return
         m = {
             "type": "packet",
             "node1": n1,
@@ -279,18 +531,20 @@ class StreamingInterface(object):
         }
         # if color is not None:
         #  m['stroke'] = color
-        self.send(m)
+        self.send(m, droppable=True)
 
     def send_link_down(self, srcid, sport, dstid, dport):
-        self.send(
-            {
-                "type": "unlink",
-                "node1": srcid,
-                "node2": dstid,
-                "node1_port": sport,
-                "node2_port": dport,
-            }
-        )
+        with self.topology_lock:
+            self.topology.link_down(srcid, sport, dstid, dport)
+            self.send(
+                {
+                    "type": "unlink",
+                    "node1": srcid,
+                    "node2": dstid,
+                    "node1_port": sport,
+                    "node2_port": dport,
+                }
+            )
 
     def highlight_path(self, nodes):
         """Sends a path to the GUI to be highlighted"""
@@ -22,7 +22,7 @@ import sim.core as core
 log = logging.getLogger("web")
 log.setLevel(logging.INFO)
 
-from .comm_tcp import StreamingConnection
+from .comm_tcp import StreamingConnection, PacketBatcher, TopologyIndex, Writer
 
 import posixpath
 import base64
@@ -52,15 +52,223 @@ except:
     url_unquote = urllib.parse.unquote
 
 
-try:
-    _ = b" "[0] + 1
-    # Python3
-    _ord = lambda x: x
-    _chr = lambda x: bytes([x])
-except Exception:
-    # Python2
-    _ord = ord
-    _chr = chr
+def _unmask(data, mask):
+    """XORs data with the (four byte) websocket mask, all at once"""
+    n = len(data)
+    if not n:
+        return b""
+    mask = bytes(mask * (n // 4 + 1))[:n]
+    try:
+        x = int.from_bytes(data, "little") ^ int.from_bytes(mask, "little")
+        return x.to_bytes(n, "little")
+    except AttributeError:
+        # Python 2
+        return bytes(bytearray(a ^ b for a, b in zip(bytearray(data), mask)))
+
+
+class WebSocketDeframer(object):
+    """
+    Turns the bytes a websocket client sends into messages
+
+    Give feed() whatever you've received.  For each complete message, it
+    calls on_message(opcode, payload); fragmented messages are put back
+    together first, so it's never called with WS_CONTINUE.  Control frames
+    (like pings) come through the same way.  Raises RuntimeError if the
+    client sends something which isn't right.
+
+    Received bytes go into a single buffer, which whole frames are parsed
+    out of (and unmasked) at once.
+    """
+
+    WS_CONTINUE = 0
+
+    _u16 = struct.Struct("!H")
+    _u64 = struct.Struct("!Q")
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self._buf = bytearray()
+        self._fragments = []
+        self._fragment_op = None
+
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        pos = 0
+        try:
+            while True:
+                avail = len(buf) - pos
+                if avail < 2:
+                    break
+                flags_op = buf[pos]
+                length = buf[pos + 1]
+                if not length & 0x80:
+                    raise RuntimeError("No mask set")
+                length &= 0x7F
+                header = 2
+                if length == 0x7E:
+                    header = 4
+                    if avail < header:
+                        break
+                    length = self._u16.unpack_from(buf, pos + 2)[0]
+                elif length == 0x7F:
+                    header = 10
+                    if avail < header:
+                        break
+                    length = self._u64.unpack_from(buf, pos + 2)[0]
+                start = pos + header + 4
+                end = start + length
+                if len(buf) < end:
+                    break
+                mask = buf[start - 4 : start]
+                payload = _unmask(memoryview(buf)[start:end], mask)
+                pos = end
+                self._frame(flags_op, payload)
+        finally:
+            del buf[:pos]
+
+    def _frame(self, flags_op, payload):
+        op = flags_op & 0x0F
+        fin = flags_op & 0x80
+        if op & 0x08:
+            # Control frame (these can come in the middle of fragments)
+            if not fin:
+                raise RuntimeError("Fragmented control frame")
+            self.on_message(op, payload)
+        elif op == self.WS_CONTINUE:
+            if self._fragment_op is None:
+                raise RuntimeError("Continuing unknown frame")
+            self._fragments.append(payload)
+            if fin:
+                op = self._fragment_op
+                payload = b"".join(self._fragments)
+                self._fragments = []
+                self._fragment_op = None
+                self.on_message(op, payload)
+        elif self._fragment_op is not None:
+            raise RuntimeError("Discarded partial message")
+        elif fin:
+            self.on_message(op, payload)
+        else:
+            self._fragment_op = op
+            self._fragments = [payload]
+
+
+# NetVis clients pick how they want messages with Sec-WebSocket-Protocol.
+# With the binary protocol, the high-rate messages (packets and links coming
+# and going) are sent as binary frames made by encode_binary(), and the rest
+# as JSON text frames, as usual.
+BINARY_PROTOCOL = "netvis.bin"
+JSON_PROTOCOL = "netvis.json"
+
+# A binary message is a kind byte (see _binary_kinds), then a table of the
+# node names in it (a count, and then for each a length and UTF-8 bytes),
+# then a count of records and the records.  Records refer to nodes by their
+# index in the table.  Everything is little-endian.
+_bin_count = struct.Struct("<H")
+_bin_records = struct.Struct("<I")
+_bin_packet = struct.Struct("<HHfI")  # n1, n2, ms, count, then _bin_looks
+_bin_looks = struct.Struct("<4B4BB")  # stroke, fill, drop
+_bin_link = struct.Struct("<HHHH")  # n1, n1 port, n2, n2 port
+
+_binary_kinds = {"packets": 1, "packet": 1, "links": 2, "link": 2, "unlink": 3}
+
+_WHITE = (255, 255, 255, 255)
+_CLEAR = (0, 0, 0, 0)
+
+
+def _color_bytes(color, default):
+    """Turns a NetVis color ([r, g, b] or [r, g, b, a] from 0 to 1) to bytes"""
+    try:
+        if len(color) not in (3, 4):
+            return default
+        c = [min(255, max(0, int(x * 255))) for x in color]
+    except (TypeError, ValueError):
+        return default
+    if len(c) == 3:
+        c.append(255)
+    return tuple(c)
+
+
+_looks_cache = {}
+
+
+def _looks(stroke, fill, drop):
+    """Returns the packed colors and drop flag for a packet"""
+    try:
+        key = (tuple(stroke), tuple(fill), drop)
+    except TypeError:
+        key = None
+    cache = _looks_cache
+    r = cache.get(key)
+    if r is None:
+        r = _bin_looks.pack(
+            *(_color_bytes(stroke, _WHITE) + _color_bytes(fill, _CLEAR) + (drop,))
+        )
+        if key is not None and len(cache) < 10000:
+            cache[key] = r
+    return r
+
+
+def encode_binary(msg):
+    """
+    Encodes a message for the binary NetVis protocol
+
+    Returns None if this kind of message (or this particular one) can't be
+    sent as binary, in which case it should be sent as JSON.
+    """
+    kind = _binary_kinds.get(msg.get("type"))
+    if kind is None:
+        return None
+
+    names = {}
+
+    def index(name):
+        i = names.get(name)
+        if i is None:
+            i = names[name] = len(names)
+        return i
+
+    records = []
+    try:
+        if kind == 1:
+            pack = _bin_packet.pack
+            entries = msg["packets"] if msg["type"] == "packets" else [msg]
+            count = len(entries)
+            for e in entries:
+                records.append(
+                    pack(
+                        index(e["node1"]),
+                        index(e["node2"]),
+                        e["duration"],
+                        e.get("count", 1),
+                    )
+                )
+                records.append(_looks(e["stroke"], e["fill"], 1 if e["drop"] else 0))
+        else:
+            pack = _bin_link.pack
+            if msg["type"] == "links":
+                links = msg["links"]
+            else:
+                links = [
+                    (msg["node1"], msg["node1_port"], msg["node2"], msg["node2_port"])
+                ]
+            count = len(links)
+            for n1, p1, n2, p2 in links:
+                records.append(pack(index(n1), p1, index(n2), p2))
+
+        out = [struct.pack("<B", kind), _bin_count.pack(len(names))]
+        for name in sorted(names, key=names.get):
+            name = str(name).encode("utf8")
+            out.append(_bin_count.pack(len(name)))
+            out.append(name)
+        out.append(_bin_records.pack(count))
+    except (struct.error, KeyError, TypeError):
+        # E.g., more than 65535 names or ports, a name longer than 65535
+        # bytes, or something weird
+        return None
+    out.extend(records)
+    return b"".join(out)
 
 
 class WebHandler(SimpleHTTPRequestHandler, StreamingConnection):
@@ -75,6 +283,9 @@ class WebHandler(SimpleHTTPRequestHandler, StreamingConnection):
 
     protocol_version = "HTTP/1.1"
 
+    # Send binary messages (see encode_binary()) to clients which ask?
+    ALLOW_BINARY = True
+
     def _get_base_path(self):
         return _base_path
 
@@ -120,47 +331,9 @@ class WebHandler(SimpleHTTPRequestHandler, StreamingConnection):
         """
         return self.rfile
 
-    def _send_initialize(self):
-        def make(a, A, b, B):
-            a = a.entity.name
-            b = b.entity.name
-            if a <= b:
-                return (a, A, b, B)
-            return (b, B, a, A)
-
-        links = set()
-        for te in core.topo.values():
-            for n, p in enumerate(te.ports):
-                if p is None:
-                    continue
-                links.add(make(te, n, p.dst, p.dstPort))
-        links = [list(e) for e in links]
-
-        import sim.api
-
-        msg = {
-            "type": "initialize",
-            "entities": dict(
-                [
-                    (
-                        n.entity.name,
-                        "circle"
-                        if isinstance(n.entity, sim.api.HostEntity)
-                        else "square",
-                    )
-                    for n in core.topo.values()
-                ]
-            ),
-            #      'entities': {},
-            "links": links,
-        }
-        self.parent.send(msg, connections=self)
-        if core.world.info:
-            msg = {"type": "info", "text": core.world.info}
-            self.parent.send(msg, connections=self)
-
     def _close(self):
         self._websocket_open = False
+        self._writer.close()
         try:
             pass  # self.wfile.close()
         except Exception:
@@ -182,113 +355,58 @@ class WebHandler(SimpleHTTPRequestHandler, StreamingConnection):
         k = base64.b64encode(hashlib.sha1(k).digest())
         k = k.decode("UTF-8")
         self.send_header("Sec-WebSocket-Accept", k)
+        protocols = self.headers.get("Sec-WebSocket-Protocol", "")
+        protocols = [p.strip() for p in protocols.split(",")]
+        if self.ALLOW_BINARY and BINARY_PROTOCOL in protocols:
+            self.encoding = "binary"
+            self.send_header("Sec-WebSocket-Protocol", BINARY_PROTOCOL)
+        elif JSON_PROTOCOL in protocols:
+            self.send_header("Sec-WebSocket-Protocol", JSON_PROTOCOL)
         self.send_header("Upgrade", "websocket")
         self.send_header("Connection", "Upgrade")
         self.end_headers()
 
-        self.parent.connections.append(self)
-
-        self._send_initialize()
-
-        def feeder():
-            data = b""
-            old_op = None
-            hdr = b""
-            while self._websocket_open:
-                while len(hdr) < 2:
-                    newdata = yield True
-                    if newdata:
-                        hdr += newdata
-
-                flags_op, len1 = struct.unpack_from("!BB", hdr, 0)
-                op = flags_op & 0x0F
-                flags = flags_op >> 4
-                fin = flags & 0x8
-                if (len1 & 0x80) == 0:
-                    raise RuntimeError("No mask set")
-                len1 &= 0x7F
-                hdr = hdr[2:]
+        self._writer = Writer(self._send_real, self._write_failed)
+
+        def on_message(op, d):
+            if op == self.WS_TEXT:
+                d = d.decode("utf8")
+
+            if op in (self.WS_TEXT, self.WS_BINARY):
+                self._ws_message(op, d)
+            elif op == self.WS_PING:
+                msg = self._frame(self.WS_PONG, d)
+                self._writer.put(msg)
+            elif op == self.WS_CLOSE:
+                if self._websocket_open:
+                    self._websocket_open = False
+                    # TODO: Send close frame?
+            elif op == self.WS_PONG:
+                pass
+            else:
+                pass  # Do nothing for unknown type
 
-                while True:
-                    if len1 <= 0x7D:
-                        length = len1
-                        break
-                    elif len1 == 0x7E and len(hdr) >= 2:
-                        length = struct.unpack_from("!H", hdr, 0)
-                        hdr = hdr[2:]
-                        break
-                    elif len1 == 0x7F and len(hdr) >= 8:
-                        length = struct.unpack_from("!Q", hdr, 0)
-                        hdr = hdr[8:]
-                        break
-                    else:
-                        raise RuntimeError("Bad length")
-                    hdr += yield True
-
-                while len(hdr) < 4:
-                    hdr += yield True
-
-                mask = [_ord(x) for x in hdr[:4]]
-                hdr = hdr[4:]
-
-                while len(hdr) < length:
-                    hdr += yield True
-
-                d = hdr[:length]
-                hdr = hdr[length:]
-
-                d = b"".join(_chr(_ord(c) ^ mask[i % 4]) for i, c in enumerate(d))
-
-                if not fin:
-                    if op == self.WS_CONTINUE:
-                        if old_op is None:
-                            raise RuntimeError("Continuing unknown opcode")
-                    else:
-                        if old_op is not None:
-                            raise RuntimeError("Discarded partial message")
-                        old_op = op
-                    data += d
-                else:  # fin
-                    if op == self.WS_CONTINUE:
-                        if old_op is None:
-                            raise RuntimeError("Can't continue unknown frame")
-                        op = old_op
-                    d = data + d
-                    old_op = None
-                    data = b""
-                    if op == self.WS_TEXT:
-                        d = d.decode("utf8")
-
-                    if op in (self.WS_TEXT, self.WS_BINARY):
-                        self._ws_message(op, d)
-                    elif op == self.WS_PING:
-                        msg = self._frame(self.WS_PONG, d)
-                        self._send_real(msg)
-                    elif op == self.WS_CLOSE:
-                        if self._websocket_open:
-                            self._websocket_open = False
-                            # TODO: Send close frame?
-                    elif op == self.WS_PONG:
-                        pass
-                    else:
-                        pass  # Do nothing for unknown type
-
-        deframer = feeder()
-        try:
-            deframer.send(None)
-        except StopIteration:
-            pass  # PEP 479?
+        deframer = WebSocketDeframer(on_message)
 
-        # This is nutso, but it just might work.
-        # *Try* to read individual bytes from rfile in case it has some
-        # buffered.  When it fails, switch to reading from connection.
+        # rfile may have some of the websocket data buffered already (it's
+        # read along with the HTTP request), so feed that in before switching
+        # to reading from the connection.
         self.connection.settimeout(0)
+        read = getattr(self.rfile, "read1", None) or self.rfile.read
         while True:
             try:
-                deframer.send(self.rfile.read(1))
+                d = read(65536)
+                if not d:
+                    break  # Nothing more buffered
+                deframer.feed(d)
             except Exception:
                 break
 
+        # The Writer needs blocking writes (it's the only thing which waits on
+        # them), so only start sending once we're done with the above.
+        self.connection.settimeout(None)
+        self._send_initialize()
+
         import select
 
         while self._websocket_open:
@@ -305,8 +423,10 @@ class WebHandler(SimpleHTTPRequestHandler, StreamingConnection):
                 break
             if len(rx):
                 try:
-                    r = self.connection.recv(4096)
-                    deframer.send(r)
+                    r = self.connection.recv(65536)
+                    if not r:
+                        break  # Closed
+                    deframer.feed(r)
                 except Exception:
                     # TODO: reopen
                     break
@@ -396,24 +516,17 @@ class WebHandler(SimpleHTTPRequestHandler, StreamingConnection):
         return hdr + msg
 
     def send_raw(self, msg):
-        try:
-            msg = self._frame(self.WS_TEXT, msg.encode())
-            self._send_real(msg)
-        except Exception as e:
-            raise
+        self._writer.put(self._frame(self.WS_TEXT, msg.encode()))
 
     def _send_real(self, msg):
-        try:
-            self.wfile.write(msg)
-            self.wfile.flush()
-        except Exception:
-            try:
-                self.server._disconnect()
-            except Exception:
-                pass
-            self._websocket_open = False
-            # TODO: reopen?
-            pass
+        # Only called from the Writer's thread
+        self.wfile.write(msg)
+        self.wfile.flush()
+
+    def _write_failed(self):
+        self._websocket_open = False
+        # TODO: reopen?
+        self.server._disconnect(self)
 
 
 ThreadingMixIn.daemon_threads = True
@@ -422,6 +535,11 @@ ThreadingMixIn.daemon_threads = True
 class WebInterface(ThreadingMixIn, HTTPServer):
     def __init__(self):
         self.connections = []
+        self.topology = TopologyIndex()
+        self.topology_lock = threading.Lock()
+        self._packets = None
+        if sim.config.packet_animation_rate:
+            self._packets = PacketBatcher(self)
 
         try:
             HTTPServer.__init__(
@@ -463,16 +581,37 @@ class WebInterface(ThreadingMixIn, HTTPServer):
         except Exception:
             pass
 
-    def send(self, msg, connections=None):
+    def _encode(self, msg, encoding):
+        """Turns a message into a websocket frame"""
+        if encoding == "binary":
+            data = encode_binary(msg)
+            if data is not None:
+                return WebHandler._frame(WebHandler.WS_BINARY, data)
+        data = (json.dumps(msg, default=repr) + "\n").encode()
+        return WebHandler._frame(WebHandler.WS_TEXT, data)
+
+    def send(self, msg, connections=None, droppable=False):
+        """
+        Sends a message to all the connections (or just the ones given)
+
+        The message is encoded just once for each encoding the connections
+        use, however many connections there are.
+        If droppable, slow connections may not get it (see Writer).
+        """
         if connections is None:
-            connections = self.connections
+            connections = list(self.connections)
         elif not isinstance(connections, list):
             connections = [connections]
-        r = json.dumps(msg, default=repr) + "\n"
+        if not connections:
+            return
+        encoded = {}
         bad = []
         for c in connections:
             try:
-                c.send_raw(r)
+                data = encoded.get(c.encoding)
+                if data is None:
+                    data = encoded[c.encoding] = self._encode(msg, c.encoding)
+                c.send_encoded(data, droppable)
             except Exception:
                 bad.append(c)
         for c in bad:
@@ -492,35 +631,56 @@ class WebInterface(ThreadingMixIn, HTTPServer):
     def send_log(self, record):
         self.send(record)
 
+    # The topology messages go out with topology_lock held (see
+    # StreamingConnection._send_initialize()).
+
     def send_entity_down(self, name):
-        self.send(
-            {
-                "type": "delEntity",
-                "node": name,
-            }
-        )
+        with self.topology_lock:
+            self.topology.entity_down(name)
+            self.send(
+                {
+                    "type": "delEntity",
+                    "node": name,
+                }
+            )
 
     def send_entity_up(self, name, kind):
-        self.send(
-            {
-                "type": "addEntity",
-                "kind": "square" if kind == "switch" else "circle",
-                "label": name,
-            }
-        )
+        kind = "square" if kind == "switch" else "circle"
+        with self.topology_lock:
+            self.topology.entity_up(name, kind)
+            self.send(
+                {
+                    "type": "addEntity",
+                    "kind": kind,
+                    "label": name,
+                }
+            )
 
     def send_link_up(self, srcid, sport, dstid, dport):
-        self.send(
-            {
-                "type": "link",
-                "node1": srcid,
-                "node2": dstid,
-                "node1_port": sport,
-                "node2_port": dport,
-            }
-        )
+        with self.topology_lock:
+            self.topology.link_up(srcid, sport, dstid, dport)
+            self.send(
+                {
+                    "type": "link",
+                    "node1": srcid,
+                    "node2": dstid,
+                    "node1_port": sport,
+                    "node2_port": dport,
+                }
+            )
+
+    def send_links_up(self, links):
+        with self.topology_lock:
+            for link in links:
+                self.topology.link_up(*link)
+            self.send({"type": "links", "links": [list(l) for l in links]})
 
     def packet(self, n1, n2, packet, duration, drop=False):
+        if not self.connections:
+            return
+        if self._packets is not None:
+            self._packets.add(n1, n2, packet, duration, drop)
+            return
         m = {
             "type": "packet",
             "node1": n1,
@@ -532,18 +692,20 @@ class WebInterface(ThreadingMixIn, HTTPServer):
         }
         # if color is not None:
         #  m['stroke'] = color
-        self.send(m)
+        self.send(m, droppable=True)
 
     def send_link_down(self, srcid, sport, dstid, dport):
-        self.send(
-            {
-                "type": "unlink",
-                "node1": srcid,
-                "node2": dstid,
-                "node1_port": sport,
-                "node2_port": dport,
-            }
-        )
+        with self.topology_lock:
+            self.topology.link_down(srcid, sport, dstid, dport)
+            self.send(
+                {
+                    "type": "unlink",
+                    "node1": srcid,
+                    "node2": dstid,
+                    "node1_port": sport,
+                    "node2_port": dport,
+                }
+            )
 
     def highlight_path(self, nodes):
         """Sends a path to the GUI to be highlighted"""
@@ -11,11 +11,10 @@ import sys
 import sim
 import copy
 import threading
-
-try:
-    import queue as Queue
-except ImportError:
-    import Queue
+import heapq
+import bisect
+import math
+import random as _random
 import time
 import weakref
 
@@ -47,6 +46,8 @@ class EventLogger(logging.Handler):
     #  logging.Handler.__init__(self, *args, **kw)
 
     def emit(self, record):
+        if world is not None and not world.gui_events:
+            return  # Headless
         o = {"message": self.format(record)}
         o["type"] = "log"
         if True:
@@ -73,7 +74,8 @@ if sim.config.console_log:
 else:
     logging.getLogger().setLevel(logging.DEBUG)
 
-logging.getLogger().addHandler(EventLogger())
+_event_logger = EventLogger()
+logging.getLogger().addHandler(_event_logger)
 simlog = logging.getLogger("simulator")
 userlog = logging.getLogger("user")
 
@@ -128,16 +130,21 @@ class Timer(object):
 
     def __init__(self, seconds, target=None, args=(), kw={}, passSelf=False):
         self.seconds = seconds
-        world.doLater(seconds, self.timeout)
-        self.func = target
         self.stopped = False
+        self._slot = None
+        self.func = target
         self.args = list(args)
         self.kw = dict(kw)
         if passSelf:
             self.args = [self] + self.args
+        self._schedule()  # Last, since it may fire right away on another thread
+
+    def _schedule(self):
+        world.timers.add(self, self.seconds)
 
     def cancel(self):
         self.stopped = True
+        world.timers.remove(self)
 
     def timer(self):
         if self.func:
@@ -148,8 +155,8 @@ class Timer(object):
             return
         try:
             rv = self.timer()
-            if rv is not False:
-                world.doLater(self.seconds, self.timeout)
+            if rv is not False and not self.stopped:
+                self._schedule()
         except Exception:
             simlog.exception("Exception while executing a timer")
             # traceback.print_exc()
@@ -159,6 +166,13 @@ class OneShot(Timer):
     """It's a single-shot timer.
     You should just create this with api.create_timer()."""
 
+    def _schedule(self):
+        self._event = world.doLater(self.seconds, self.timeout)
+
+    def cancel(self):
+        self.stopped = True
+        self._event.cancel()
+
     def timeout(self):
         if self.stopped:
             return
@@ -169,26 +183,335 @@ class OneShot(Timer):
             # traceback.print_exc()
 
 
+class _TimerSlot(object):
+    __slots__ = ("key", "timers", "live", "event")
+
+
+class TimerWheel(object):
+    """
+    Schedules recurring Timers in shared slots
+
+    Rather than each Timer having its own entry in the World's queue, all
+    the timers due at the same time share a slot, and each slot has a single
+    queue entry.  When a slot comes due, its timers run in the order they
+    were added, so the cost is proportional to the number of due timers.
+    Since timers with the same period which fired together get rescheduled
+    together, thousands of routers on the same interval stay in one slot.
+
+    With real time, due times are rounded up to RESOLUTION so that timers
+    started a few microseconds apart still share.  With virtual time, they
+    are left alone (the World sets .resolution accordingly).
+
+    Cancelled timers are dropped from their slot lazily; if a slot ends up
+    with no timers, its queue entry is cancelled.
+
+    Timers can be started and cancelled from other threads (e.g., the
+    console), so the slots are protected by a lock.  It's taken before the
+    World queue's, never after.
+    """
+
+    RESOLUTION = 0.001
+
+    def __init__(self, world):
+        self.world = world
+        self.resolution = self.RESOLUTION
+        self._slots = {}  # due time -> _TimerSlot
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def add(self, timer, seconds):
+        world = self.world
+        with self._lock:
+            t = world.time + seconds
+            if self.resolution:
+                t = math.ceil(t / self.resolution) * self.resolution
+            slot = self._slots.get(t)
+            if slot is None:
+                slot = _TimerSlot()
+                slot.key = t
+                slot.timers = []
+                slot.live = 0
+                slot.event = world.doAt(t, self._fire, slot)
+                self._slots[t] = slot
+            slot.timers.append(timer)
+            slot.live += 1
+            timer._slot = slot
+
+    def remove(self, timer):
+        with self._lock:
+            slot = timer._slot
+            if slot is None:
+                return
+            timer._slot = None
+            slot.live -= 1
+            if not slot.live:
+                slot.event.cancel()
+                if self._slots.get(slot.key) is slot:
+                    del self._slots[slot.key]
+
+    def _fire(self, slot):
+        with self._lock:
+            if self._slots.get(slot.key) is slot:
+                del self._slots[slot.key]
+            # Once it's out of _slots, nothing more gets added to it
+            due = [timer for timer in slot.timers if timer._slot is slot]
+            for timer in due:
+                timer._slot = None
+        profiler = self.world.profiler
+        for timer in due:
+            if profiler is None:
+                timer.timeout()
+            else:
+                profiler.fire_timer(timer)
+
+
+class ScheduledEvent(list):
+    """
+    An entry in the World's EventQueue
+
+    It's a [time, count, method, args, kw] list, which lets the heap compare
+    entries without calling back into Python.  It's also the handle returned
+    by doLater() and friends, so you can cancel() it.
+    """
+
+    __slots__ = ("queue",)
+
+    @property
+    def time(self):
+        return self[0]
+
+    @property
+    def cancelled(self):
+        return self[2] is None
+
+    def cancel(self):
+        """
+        Keeps the event from running
+
+        This is O(1): the entry is left in the heap as a tombstone which is
+        skipped when it reaches the head (or thrown out by compaction).
+        Cancelling an event which has already run does nothing.
+        """
+        q = self.queue
+        if q is not None:
+            q.cancel(self)
+
+
+class EventQueue(object):
+    """
+    The World's queue of pending events
+
+    This is a single heap of ScheduledEvents.  The count breaks ties so that
+    events scheduled for the same time run in the order they were scheduled
+    (and so that we never compare methods).  The count is None while the
+    event isn't actually in the heap (before it's scheduled and once it has
+    been popped for dispatch).
+
+    The condition variable protects the heap.  Other threads (e.g., the GUI)
+    add events with push(), which wakes the World thread if the new event
+    is now the earliest one.
+
+    Cancelled events stay in the heap as tombstones (their method is None).
+    Once there are more than COMPACT_MIN of them and they make up more than
+    half the heap, the heap is rebuilt without them.
+    """
+
+    COMPACT_MIN = 64
+
+    def __init__(self):
+        self._heap = []
+        self._count = 0
+        self._dead = 0
+        self.compactions = 0
+        self.cv = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        return len(self._heap) - self._dead
+
+    def new(self, t, method, args, kw):
+        """Makes an event for this queue without scheduling it"""
+        ev = ScheduledEvent((t, None, method, args, kw))
+        ev.queue = self
+        return ev
+
+    def push(self, t, method, args, kw):
+        ev = ScheduledEvent((t, None, method, args, kw))
+        self.schedule(ev)
+        return ev
+
+    def schedule(self, ev):
+        with self.cv:
+            ev[1] = self._count
+            self._count += 1
+            ev.queue = self
+            heap = self._heap
+            heapq.heappush(heap, ev)
+            if heap[0] is ev:
+                self.cv.notify()
+
+    def cancel(self, ev):
+        with self.cv:
+            if ev.queue is not self or ev[2] is None:
+                return
+            ev[2] = None
+            ev[3] = ()
+            ev[4] = {}
+            ev.queue = None
+            if ev[1] is None:
+                return  # Not in the heap yet
+            self._dead += 1
+            if self._dead > self.COMPACT_MIN and self._dead * 2 > len(self._heap):
+                self._compact()
+
+    def _compact(self):
+        heap = self._heap
+        heap[:] = [ev for ev in heap if ev[2] is not None]
+        heapq.heapify(heap)
+        self._dead = 0
+        self.compactions += 1
+
+    def peek(self):
+        """Returns the earliest live event without removing it (or None)"""
+        heap = self._heap
+        while heap:
+            ev = heap[0]
+            if ev[2] is not None:
+                return ev
+            heapq.heappop(heap)
+            self._dead -= 1
+        return None
+
+    def pop_due(self, t):
+        """
+        Removes and returns all live events due at or before t.  Hold cv.
+
+        They're returned in order.  They no longer count as being in the
+        heap, but they can be cancelled right up until they're dispatched
+        (e.g., by an earlier event in the same batch).
+        """
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= t:
+            ev = heapq.heappop(heap)
+            if ev[2] is None:
+                self._dead -= 1
+                continue
+            ev[1] = None
+            due.append(ev)
+        return due
+
+    def stats(self):
+        """Returns counts of live and dead (cancelled) entries in the heap"""
+        with self.cv:
+            return dict(
+                live=len(self._heap) - self._dead,
+                dead=self._dead,
+                compactions=self.compactions,
+            )
+
+    def wake(self):
+        with self.cv:
+            self.cv.notify_all()
+
+
+class Simulation(object):
+    """
+    Everything that makes up a single simulation
+
+    That's the World, the event interface, the topology registry (entity ->
+    TopoNode) and the name registry (name -> entity).
+
+    The module-level world, events, and topo (which is what most code uses)
+    are those of the current Simulation.  Creating a World creates a new
+    Simulation and makes it current, and a World makes its own Simulation
+    current whenever it dispatches events.  So you can run any number of
+    simulations one after the other in the same process, or interleave them
+    in one thread with World.run_until().  Running them in separate threads
+    at the same time is *not* supported.
+
+    Entity names are also made into builtins (so you can just type "h1" at
+    the console), but only those of the current Simulation.
+
+    Each Simulation also has its own random number generator, which the
+    simulator itself uses (e.g., for cable seeds) through rand(), and a
+    separate one for packet colors.  Colors are only picked when a GUI looks
+    at them, so they mustn't draw from (and change) rand()'s sequence.
+    """
+
+    def __init__(self):
+        self.world = None
+        self.events = None
+        self.topo = weakref.WeakValueDictionary()
+        self.names = {}
+        self.rng = _random.Random()
+        self.random = self.rng.random  # May be replaced (e.g., for replay)
+        self.color_rng = _random.Random()
+
+    def activate(self):
+        """Makes this the current Simulation"""
+        global current, world, events, topo, rand, color_rand
+        old = current
+        if old is not None and old is not self:
+            for name, e in old.names.items():
+                if _builtin.get(name) is e:
+                    del _builtin[name]
+        _builtin.update(self.names)
+        current = self
+        world = self.world
+        events = self.events
+        topo = self.topo
+        rand = self.random
+        color_rand = self.color_rng.random
+        if self.world is not None:
+            self.world._install_api()
+
+    def cables(self):
+        """
+        Yields every Cable which is plugged in
+
+        They're in order of their source entity's name and port.
+        """
+        nodes = sorted(self.topo.values(), key=lambda te: te.entity.name)
+        for te in nodes:
+            ports = te.ports
+            for i in te._live_ports:
+                yield ports[i]
+
+
+current = None
 world = None
 events = None
+rand = _random.random  # The current Simulation's random()
+color_rand = _random.random  # The current Simulation's random() for colors
+
+
+def _current_time():
+    return world.time
 
 
 class World(object):
     """Mostly this dispatches events in the simulator."""
 
-    def __init__(self):
-        global world
-        world = self
+    def __init__(self, simulation=None, headless=None):
+        if simulation is None:
+            simulation = Simulation()
+        self.simulation = simulation
+        simulation.world = self
+        self.profiler = None
 
-        self.queue = Queue.PriorityQueue()
+        self.queue = EventQueue()
+        self.timers = TimerWheel(self)
         self._thread = None
-        self._count = 0
         self.ended = False
+        self.exception = None  # The exception which ended the run loop, if any
 
         # When the world isn't running, items are put in the prelist.
         # They're added to the queue when the world is started, and
         # their start times are adjusted so that they are relative to
         # when the world was started, NOT to when they were added.
+        # Until then, their time is relative.
         self._prelist = []
 
         self.function_handler = {}  # number -> handler for user-specific functions
@@ -205,8 +528,91 @@ class World(object):
         self.trace = False
         self._running = True
 
-        self.virtual_time = False
+        # If True, each batch of events only contains events due at exactly
+        # the same time, even in real time (see sim.replay).
+        self._exact_batches = False
+
+        self.virtual_time = sim.config.virtual_time
+
+        # In headless mode, cables and TopoNodes don't even call the event
+        # interface, and log records aren't turned into events.  TopoNodes
+        # copy this when they're made and cables when they're plugged in, so
+        # it only affects this World.
+        if headless is None:
+            headless = sim.config.headless
+        self.gui_events = not headless
+
+        should_sleep = sim.config.interactive
+        if headless:
+            import sim.comm as interface
+
+            should_sleep = False
+        elif sim.config.remote_interface == "tcp":
+            import sim.comm_tcp as interface
+        elif sim.config.remote_interface == "udp":
+            import sim.comm_udp as interface
+        elif sim.config.remote_interface == "web":
+            import sim.comm_web as interface
+        else:
+            import sim.comm as interface
+
+            should_sleep = False
+        simulation.events = interface.interface()
+        simulation.activate()
+        if sim.config.record:
+            self.record(sim.config.record)
+        elif sim.config.replay:
+            self.replay(sim.config.replay, sim.config.replay_until)
+        if sim.config.profile:
+            self.enable_profiling(sim.config.profile)
+        if should_sleep:
+            # Sleep a sec to allow remote to possibly connect
+            time.sleep(1)
+
+    def record(self, filename):
+        """
+        Records this simulation to filename so it can be replayed
+
+        Call this before creating any entities.  See sim.replay.
+        """
+        from sim.replay import Recorder
+
+        return Recorder(self, filename)
+
+    def replay(self, filename, until=None):
+        """
+        Sets this World up to replay a recording made with record()
+
+        Set up the same simulation as was recorded (same modules and
+        arguments) and then start it.  If until is given, the simulation
+        stops after that many events.  See sim.replay.
+        """
+        from sim.replay import Replayer
+
+        return Replayer(self, filename, until)
+
+    def enable_profiling(self, filename=None):
+        """
+        Starts collecting timing information about the event loop
 
+        See sim.profiler.  If filename is given, the results are written
+        to it as JSON at exit.  Returns the Profiler.
+        """
+        from sim.profiler import Profiler, ProfiledInterface
+
+        if self.profiler is None:
+            self.profiler = Profiler(self, filename)
+            self._dispatch = self.profiler.dispatch
+            simulation = self.simulation
+            simulation.events = ProfiledInterface(simulation.events, self.profiler)
+            if current is simulation:
+                simulation.activate()
+            for e in simulation.names.values():
+                self.profiler.wrap_entity(e)
+        return self.profiler
+
+    def _install_api(self):
+        """Points the bits of sim.api which belong to a World at this one"""
         import sim.api as api
 
         api.netvis._a = lambda: _getEntByName(self.a)
@@ -227,24 +633,7 @@ class World(object):
 
         api.netvis.set_selection_callback = set_selection_callback
 
-        sim.api.current_time = lambda: self.time
-
-        global events
-        should_sleep = sim.config.interactive
-        if sim.config.remote_interface == "tcp":
-            import sim.comm_tcp as interface
-        elif sim.config.remote_interface == "udp":
-            import sim.comm_udp as interface
-        elif sim.config.remote_interface == "web":
-            import sim.comm_web as interface
-        else:
-            import sim.comm as interface
-
-            should_sleep = False
-        events = interface.interface()
-        if should_sleep:
-            # Sleep a sec to allow remote to possibly connect
-            time.sleep(1)
+        sim.api.current_time = _current_time
 
     @property
     def virtual_time(self):
@@ -256,14 +645,19 @@ class World(object):
         for attr in "_get_time run".split():
             prefix = "" if attr.startswith("_") else "_"
             setattr(self, attr, getattr(self, prefix + attr + extra))
+        self.timers.resolution = 0 if virtual_time else TimerWheel.RESOLUTION
 
     def stop(self):
         self._running = False
+        self.queue.wake()
 
     def _get_time_real(self):
         # if self._start_time is None:
         return time.time()
 
+    def _get_time_virtual(self):
+        return self._time
+
     @property
     def time(self):
         return self._get_time()
@@ -285,11 +679,10 @@ class World(object):
 
     def _real_doLater(_self, _seconds, _method, *_args, **_kw):
         t = _self.time + _seconds
-        _self._real_doAt(t, _method, *_args, **_kw)
+        return _self.queue.push(t, _method, _args, _kw)
 
     def _real_doAt(_self, _t, _method, *_args, **_kw):
-        _self.queue.put((_t, _self._count, _method, _args, _kw))
-        _self._count += 1
+        return _self.queue.push(_t, _method, _args, _kw)
 
     @property
     def info(self):
@@ -298,7 +691,7 @@ class World(object):
     def _set_info(self, text):
         self._info = str(text)
         # TODO: Restore on reconnect
-        events.send_info(self._info)
+        self.simulation.events.send_info(self._info)
 
     @info.setter
     def info(self, text):
@@ -308,9 +701,7 @@ class World(object):
         assert self._thread is None
         simlog.info("Starting simulation.")
 
-        for a, b, c, d in self._prelist:
-            self._real_doLater(a, b, *c, **d)
-        self._prelist = []
+        self._flush_prelist()
 
         if threaded:
             self._thread = threading.Thread(target=self.run)
@@ -320,20 +711,69 @@ class World(object):
             self._thread = threading.current_thread()
             self.run()
 
+    def _start_time(self):
+        """Returns the time the simulation starts at (see sim.replay)"""
+        return self.time
+
+    def _flush_prelist(self):
+        now = self._start_time()
+        for ev in self._prelist:
+            if ev.cancelled:
+                continue
+            ev[0] += now
+            self.queue.schedule(ev)
+        self._prelist = []
+
+    def run_until(self, t):
+        """
+        Runs the simulation up to (virtual) time t and then returns
+
+        Unlike start(), this runs in the calling thread and can be called
+        again and again, so you can step a simulation along or interleave
+        several of them.  Exceptions (including SystemExit) propagate to
+        the caller.
+        """
+        assert self.virtual_time, "run_until() requires virtual time"
+        if self._thread is None:
+            self._thread = threading.current_thread()
+            self._flush_prelist()
+        queue = self.queue
+        while self._running:
+            with queue.cv:
+                o = queue.peek()
+                if o is None or o[0] > t:
+                    break
+                due = queue.pop_due(o[0])
+            if o[0] > self._time:
+                self._time = o[0]
+            self._dispatch_batch(due)
+        if t > self._time:
+            self._time = t
+
     def do(self, _method, *args, **kw):
-        self.doLater(0, _method, *args, **kw)
+        return self.doLater(0, _method, *args, **kw)
 
     def doLater(_self, _seconds, _method, *_args, **_kw):
+        """
+        Schedules _method to be called in _seconds
+
+        Returns a ScheduledEvent, which you can cancel().
+        """
         if _self._thread is not None:
-            _self._real_doLater(_seconds, _method, *_args, **_kw)
-        else:
-            _self._prelist.append((_seconds, _method, _args, _kw))
+            return _self._real_doLater(_seconds, _method, *_args, **_kw)
+        ev = _self.queue.new(_seconds, _method, _args, _kw)
+        _self._prelist.append(ev)
+        return ev
 
     def doAt(_self, _time, _method, *_args, **_kw):
+        """
+        Schedules _method to be called at _time
+
+        Returns a ScheduledEvent, which you can cancel().
+        """
         if _self._thread is not None:
-            _self._real_doAt(_time, _method, *_args, **_kw)
-        else:
-            _self._prelist.append((_time - _self.time, _method, _args, _kw))
+            return _self._real_doAt(_time, _method, *_args, **_kw)
+        return _self.doLater(_time - _self.time, _method, *_args, **_kw)
 
     def sleep(self, seconds):
         """
@@ -351,66 +791,104 @@ class World(object):
         event.wait()
 
     def _run_real(self):
-        timeout = None
-        waiting = Queue.PriorityQueue()
+        queue = self.queue
+        cv = queue.cv
 
         try:
             while self._running:
-                try:
+                with cv:
+                    o = queue.peek()
+                    if o is None:
+                        cv.wait(5)
+                        continue
                     t = self.time
-                    while not waiting.empty():
-                        o = waiting.get()
-                        if o[0] <= t:
-                            self.queue.put(o)
-                            timeout = None
-                        else:
-                            waiting.put(o)
-                            o = waiting.get()
-                            waiting.put(o)
-                            timeout = o[0] - t
-                            break
-                    # print("World waiting for",timeout)
-
-                    o = self.queue.get(True, 5 if timeout is None else timeout)
-                except Exception:
-                    # print("empty")
-                    continue
-
-                t = self.time
-                if o[0] > t:
-                    # Hasn't expired yet...
-                    # print("recycle")
-                    waiting.put(o)
-                    o = waiting.get()
-                    waiting.put(o)
                     timeout = o[0] - t
-                    continue
-                # Expired
-                timeout = None
-                if self.trace:
-                    if hasattr(o[2], "__self__"):
-                        print(
-                            o[2].__self__.__class__.__name__
-                            + "."
-                            + o[2].__func__.__name__,
-                            end="",
-                        )
-                    else:
-                        print(o[2], end="")
-                    print(o[3], o[4] if len(o[4]) else "")
-                o[2](*o[3], **o[4])
-                self._post_hook()
+                    if timeout > 0:
+                        # Hasn't expired yet...
+                        cv.wait(timeout)
+                        continue
+                    due = queue.pop_due(o[0] if self._exact_batches else t)
+                self._dispatch_batch(due)
+        except KeyboardInterrupt:
+            pass
+        except SystemExit:
+            simlog.debug("Simulation stopped")
+            raise
+        except:
+            self.exception = sys.exc_info()[1]
+            simlog.exception("Simulation ended due to exception")
+        finally:
+            simlog.debug("Simulation ended")
+            self.ended = True
+
+    def _run_virtual(self):
+        """
+        Discrete-event main loop
+
+        Rather than waiting for the wall clock to catch up with the next
+        event, we just advance the clock to it.  The clock never moves
+        backwards, so something scheduled in the past runs "now".
+        If the queue is empty, we wait for something (e.g., the GUI or the
+        console) to put something in it.
+        """
+        queue = self.queue
+        cv = queue.cv
+
+        try:
+            while self._running:
+                with cv:
+                    o = queue.peek()
+                    if o is None:
+                        cv.wait(5)
+                        continue
+                    t = o[0]
+                    due = queue.pop_due(t)
+
+                if t > self._time:
+                    self._time = t
+                self._dispatch_batch(due)
         except KeyboardInterrupt:
             pass
         except SystemExit:
             simlog.debug("Simulation stopped")
             raise
         except:
+            self.exception = sys.exc_info()[1]
             simlog.exception("Simulation ended due to exception")
         finally:
             simlog.debug("Simulation ended")
             self.ended = True
 
+    def _dispatch_batch(self, due):
+        """
+        Dispatches a batch of events which are all due
+
+        Anything they schedule for the same time has a later count, so it
+        goes in the next batch, which keeps everything in FIFO order.
+        """
+        if current is not self.simulation:
+            self.simulation.activate()
+        for o in due:
+            if o[2] is None:
+                continue  # Cancelled after it was pulled off the heap
+            if not self._running:
+                break
+            o.queue = None
+            self._dispatch(o)
+
+    def _dispatch(self, o):
+        if self.trace:
+            if hasattr(o[2], "__self__"):
+                print(
+                    o[2].__self__.__class__.__name__ + "." + o[2].__func__.__name__,
+                    end="",
+                )
+            else:
+                print(o[2], end="")
+            print(o[3], o[4] if len(o[4]) else "")
+        o[2](*o[3], **o[4])
+        self._post_hook()
+
     def _post_hook(self):
         pass
 
@@ -421,6 +899,7 @@ class TopoNode(object):
 
     ENABLE_TTL = True
     DEFAULT_CABLE_TYPE = None  # Will default to BasicCable
+    gui_events = True  # Tell the event interface about links? (headless = no)
 
     def __repr__(self):
         e = str(self.entity)
@@ -440,6 +919,20 @@ class TopoNode(object):
         self.ports = [None] * numPorts
         self.growPorts = growPorts
         self.entity = None
+        self._live_ports = []  # Sorted indexes of ports with a cable
+        self.gui_events = world.gui_events
+
+    def _set_port(self, index, cable):
+        """Puts a cable (or None) on a port, keeping _live_ports up to date"""
+        self.ports[index] = cable
+        live = self._live_ports
+        i = bisect.bisect_left(live, index)
+        present = i < len(live) and live[i] == index
+        if cable is None:
+            if present:
+                del live[i]
+        elif not present:
+            live.insert(i, index)
 
     def linkTo(self, topoEntity, cable=None, fillEmpty=True, latency=None):
         """
@@ -455,67 +948,84 @@ class TopoNode(object):
           and
          a.linkTo(b, (C, D))
         """
-        from sim.cable import Cable, BasicCable
-
-        default_cable_type = self.DEFAULT_CABLE_TYPE or BasicCable
-        if cable is None:
-            cable = (default_cable_type, default_cable_type)
-        elif isinstance(cable, Cable):
-            raise RuntimeError("Can't share a single Cable in both directions!")
-        elif isinstance(cable, tuple):
-            pass
-        #    elif isinstance(cable, BidirectionalCable):
-        else:
-            cable = (cable, cable)
-
-        def fixCableEnd(c, le, lp, re, rp):
-            if c is None:
-                c = default_cable_type
-            # Add latency if the c is BasicCable - Kaifei Chen(kaifei@berkeley.edu)
-            if isinstance(c, type) and issubclass(c, BasicCable):
-                c = c(latency=latency)
-            elif isinstance(c, type) and issubclass(c, Cable):
-                c = c()
-            c.initialize(le, lp, re, rp)
-            return c
-
+        cable = self._cable_types(cable)
         topoEntity = topoOf(topoEntity)
 
-        def getPort(entity):
-            if not fillEmpty or entity.ports.count(None) == 0:
-                assert self.growPorts
-                entity.ports.append(None)
-                return len(entity.ports) - 1
-            return entity.ports.index(None)
-
         assert topoEntity is not self
 
-        remotePort = getPort(topoEntity)
-        localPort = getPort(self)
+        remotePort = topoEntity._free_port(fillEmpty)
+        localPort = self._free_port(fillEmpty)
 
-        world.doLater(
-            0,
-            events.send_link_up,
-            self.entity.name,
-            localPort,
-            topoEntity.entity.name,
-            remotePort,
-        )
+        if self.gui_events:
+            world.doLater(
+                0,
+                events.send_link_up,
+                self.entity.name,
+                localPort,
+                topoEntity.entity.name,
+                remotePort,
+            )
 
         if cable[0] is not None:
-            c = fixCableEnd(cable[0], self, localPort, topoEntity, remotePort)
-            self.ports[localPort] = c
+            c = self._make_cable(
+                cable[0], latency, self, localPort, topoEntity, remotePort
+            )
+            self._set_port(localPort, c)
 
             world.do(_catch, self.entity.handle_link_up, localPort, c.latency)
 
         if cable[1] is not None:
-            c = fixCableEnd(cable[1], topoEntity, remotePort, self, localPort)
-            topoEntity.ports[remotePort] = c
+            c = self._make_cable(
+                cable[1], latency, topoEntity, remotePort, self, localPort
+            )
+            topoEntity._set_port(remotePort, c)
 
             world.do(_catch, topoEntity.entity.handle_link_up, remotePort, c.latency)
 
         return (localPort, remotePort)
 
+    def _cable_types(self, cable):
+        """Turns linkTo()'s cable argument into a (S->D, D->S) tuple"""
+        from sim.cable import Cable, BasicCable
+
+        default_cable_type = self.DEFAULT_CABLE_TYPE or BasicCable
+        if cable is None:
+            return (default_cable_type, default_cable_type)
+        elif isinstance(cable, Cable):
+            raise RuntimeError("Can't share a single Cable in both directions!")
+        elif isinstance(cable, tuple):
+            return cable
+        #    elif isinstance(cable, BidirectionalCable):
+        return (cable, cable)
+
+    def _make_cable(self, c, latency, le, lp, re, rp):
+        """Gets a Cable for one direction of a link and initializes it"""
+        from sim.cable import Cable, BasicCable
+
+        if c is None:
+            c = self.DEFAULT_CABLE_TYPE or BasicCable
+        # Add latency if the c is BasicCable - Kaifei Chen(kaifei@berkeley.edu)
+        if isinstance(c, type) and issubclass(c, BasicCable):
+            c = c(latency=latency)
+        elif isinstance(c, type) and issubclass(c, Cable):
+            c = c()
+        c.initialize(le, lp, re, rp)
+        return c
+
+    def _free_port(self, fillEmpty=True, start=0):
+        """
+        Returns the number of a port with nothing plugged into it
+
+        If fillEmpty is False (or all the ports are in use), it's a new one.
+        Otherwise it's the first empty port from start on (so start must not
+        be past the first empty port).
+        """
+        if not fillEmpty or len(self._live_ports) == len(self.ports):
+            assert self.growPorts
+            self.ports.append(None)
+            return len(self.ports) - 1
+        return self.ports.index(None, start)
+
     def unlinkTo(self, topoEntity, right_now=False):
         topoEntity = topoOf(topoEntity)
 
@@ -526,19 +1036,19 @@ class TopoNode(object):
             other = port.dst
             otherPort = port.dstPort
             port._handle_disconnect()
-            events.send_link_down(self.entity.name, index, other.entity.name, otherPort)
+            if self.gui_events:
+                events.send_link_down(
+                    self.entity.name, index, other.entity.name, otherPort
+                )
 
             _catch(other.entity.handle_link_down, otherPort)
             _catch(self.entity.handle_link_down, index)
 
-            other.ports[otherPort] = None
-            self.ports[index] = None
+            other._set_port(otherPort, None)
+            self._set_port(index, None)
 
-        remove = [
-            index
-            for index, value in enumerate(self.ports)
-            if value is not None and value.dst is topoEntity
-        ]
+        ports = self.ports
+        remove = [i for i in self._live_ports if ports[i].dst is topoEntity]
         for index in remove:
             if right_now:
                 world.do(goDown, index)
@@ -547,15 +1057,15 @@ class TopoNode(object):
 
     def isConnectedTo(self, other):
         other = topoOf(other)
-        for p in self.ports:
-            if p is None:
-                continue
-            if p.dst is other:
+        ports = self.ports
+        for i in self._live_ports:
+            if ports[i].dst is other:
                 return True
         return False
 
     def disconnect(self):
-        for p in (port for port in self.ports if port):
+        ports = self.ports
+        for p in [ports[i] for i in self._live_ports]:
             self.unlinkTo(p.dst)
 
     def send(self, packet, port, flood=False):
@@ -575,40 +1085,121 @@ class TopoNode(object):
         if packet.src is None:  # or (packet.src is NullAddress):
             packet.src = self.entity
 
-        if not isinstance(port, (list, set, tuple)):
-            ports = [port]
+        cables = self.ports
+        if flood:
+            if isinstance(port, (list, set, tuple)):
+                exclude = set(port)
+                ports = [p for p in self._live_ports if p not in exclude]
+            elif port is None:
+                ports = self._live_ports
+            else:
+                ports = [p for p in self._live_ports if p != port]
         elif port is None:
-            ports = []
+            return
+        elif isinstance(port, (list, set, tuple)):
+            ports = [p for p in port if 0 <= p < len(cables) and cables[p] is not None]
+        elif 0 <= port < len(cables) and cables[port] is not None:
+            ports = (port,)
         else:
-            ports = list(port)
+            return
 
-        if flood:
-            ports = [p for p in range(0, len(self.ports)) if p not in ports]
+        if not ports:
+            return
+        copy_packet = _packet_copier(packet)
+        for p in ports:
+            cables[p].transfer(copy_packet())
 
-        for remote in ports:
-            if remote >= 0 and remote < len(self.ports):
-                remote = self.ports[remote]
-                if remote is not None:
-                    p = _duplicate_packet(packet)
-                    remote.transfer(p)
 
+# Packet attributes which copies share until they're used.  See sim.api.Packet.
+_SHARED_PACKET_FIELDS = frozenset(["_trace", "_outer_color", "_inner_color"])
 
-def _duplicate_packet(p):
-    n = type(p).__new__(type(p))
-    for k, v in vars(p).items():
-        if isinstance(v, (dict, tuple, list, set)):
-            setattr(n, k, copy.copy(v))
+_packet_slots = {}  # Packet class -> [(name, slot descriptor)]
+
+
+def _get_packet_slots(cls):
+    slots = _packet_slots.get(cls)
+    if slots is None:
+        slots = []
+        for c in cls.__mro__:
+            names = c.__dict__.get("__slots__", ())
+            if isinstance(names, str):
+                names = (names,)
+            for name in names:
+                if name in ("__dict__", "__weakref__"):
+                    continue
+                if name.startswith("__") and not name.endswith("__"):
+                    name = "_" + c.__name__.lstrip("_") + name  # Mangled
+                slots.append((name, c.__dict__[name]))
+        _packet_slots[cls] = slots
+    return slots
+
+
+def _packet_copier(p):
+    """
+    Returns a function which makes copies of packet p
+
+    Getting p ready to be copied (sharing the fields which can be shared
+    and finding the ones which can't) is done once here, so sending a
+    packet out of many ports only pays for it once.  Works for packets
+    with __slots__, a __dict__, or both.
+    """
+    share = getattr(p, "_share", None)
+    if share is not None:
+        share()
+    cls = type(p)
+
+    fields = []  # (slot setter, value)
+    unshared = []  # Ones which need copying
+    for name, slot in _get_packet_slots(cls):
+        try:
+            v = slot.__get__(p, cls)
+        except AttributeError:
+            continue  # Never set
+        if name not in _SHARED_PACKET_FIELDS and isinstance(
+            v, (dict, tuple, list, set)
+        ):
+            unshared.append((slot.__set__, v))
         else:
-            setattr(n, k, v)
-    return n
+            fields.append((slot.__set__, v))
+
+    d = getattr(p, "__dict__", None)
+    unshared_keys = ()
+    if d:
+        unshared_keys = [
+            k
+            for k, v in d.items()
+            if k not in _SHARED_PACKET_FIELDS
+            and isinstance(v, (dict, tuple, list, set))
+        ]
+    else:
+        d = None
+
+    def copy_packet():
+        n = cls.__new__(cls)
+        for set_slot, v in fields:
+            set_slot(n, v)
+        if unshared:
+            for set_slot, v in unshared:
+                set_slot(n, copy.copy(v))
+        if d is not None:
+            nd = n.__dict__
+            nd.update(d)
+            for k in unshared_keys:
+                nd[k] = copy.copy(d[k])
+        return n
+
+    return copy_packet
+
+
+def _duplicate_packet(p):
+    return _packet_copier(p)()
 
 
 _builtin = sys.modules.get("__builtin__", sys.modules.get("builtins")).__dict__
 
 
 def _getByName(name):
-    # Ugh.
-    return topoOf(_builtin.get(name, None))
+    return topoOf(current.names.get(name, None))
 
 
 def _getEntByName(name):
@@ -621,6 +1212,10 @@ def _getEntByName(name):
 topo = weakref.WeakValueDictionary()
 
 
+def _no_log(msg, *args, **kw):
+    pass
+
+
 def CreateEntity(_name, _kind, *args, **kw):
     """
     Creates an Entity of kind, where kind is an Entity subclass.
@@ -628,7 +1223,8 @@ def CreateEntity(_name, _kind, *args, **kw):
     Additional arguments are pased to the new Entity's __init__().
     Returns the TopoNode containing the new Entity.
     """
-    if _name in _builtin:
+    simulation = current
+    if _name in simulation.names or _name in _builtin:
         raise NameError(str(_name) + " already exists")
     import sim.api as api
 
@@ -643,8 +1239,12 @@ def CreateEntity(_name, _kind, *args, **kw):
     te = TopoNode(numPorts, growPorts)
     te.entity = e
 
-    kind = "host" if isinstance(e, api.HostEntity) else "switch"
-    world.do(events.send_entity_up, e.name, kind)
+    if world.profiler is not None:
+        world.profiler.wrap_entity(e)
+
+    if te.gui_events:
+        kind = "host" if isinstance(e, api.HostEntity) else "switch"
+        world.do(events.send_entity_up, e.name, kind)
     simlog.info(e.name + " up!")
 
     # Add working methods
@@ -657,7 +1257,8 @@ def CreateEntity(_name, _kind, *args, **kw):
 
     def set_debug(*args):
         # print(e.name + ':', ' '.join((str(s) for s in args)))
-        world.do(events.set_debug, e.name, " ".join((str(s) for s in args)))
+        if te.gui_events:
+            world.do(events.set_debug, e.name, " ".join((str(s) for s in args)))
 
     setattr(e, "set_debug", set_debug)
 
@@ -675,24 +1276,29 @@ def CreateEntity(_name, _kind, *args, **kw):
         args = tuple([e.name] + list(args))
         func(msg, *args, **kw)
 
-    setattr(e, "log", log)
+    if not world.gui_events and not sim.config.console_log:
+        # Nobody will ever see it, so don't even build the record
+        setattr(e, "log", _no_log)
+    else:
+        setattr(e, "log", log)
 
     for m in ["linkTo", "unlinkTo", "disconnect"]:
         setattr(e, m, getattr(te, m))
 
     def remove():
         te.disconnect()
-        world.do(events.send_entity_down, _name)
-        try:
+        if te.gui_events:
+            world.do(events.send_entity_down, _name)
+        simulation.names.pop(_name, None)
+        if current is simulation and _builtin.get(_name) is e:
             del _builtin[_name]
-        except Exception:
-            pass
 
     setattr(e, "remove", remove)
 
     # Make a global variable with the right name
     # sys.modules['__main__'].__dict__[_name] = e
     # sim.__dict__[_name] = e
+    simulation.names[_name] = e
     _builtin[_name] = e
 
     # This is so we can find its TopoNode
@@ -707,3 +1313,67 @@ def topoOf(entity):
         return entity
     t = topo.get(entity, None)
     return t
+
+
+def _links_up(ups):
+    for f, port, latency in ups:
+        _catch(f, port, latency)
+
+
+def link_many(edges, latencies=None, cable=None):
+    """
+    Links a lot of pairs of entities at once
+
+    edges is a sequence of (a, b) pairs, and latencies (if given) is a
+    sequence of latencies to go with them (None for the default).  It's the
+    same as calling a.linkTo(b, cable, latency=latency) for each pair in
+    order, and the ports come out the same.  But finding free ports doesn't
+    rescan each entity's ports for every link, the event interface is told
+    about all the new links with a single send_links_up(), and all the
+    handle_link_up() calls happen in a single event.
+
+    Returns a list with the (port on a, port on b) for each pair.
+    """
+    edges = list(edges)
+    if latencies is None:
+        latencies = [None] * len(edges)
+    else:
+        latencies = list(latencies)
+        if len(latencies) != len(edges):
+            raise ValueError("Need a latency for each edge")
+
+    result = []
+    gui_links = []
+    ups = []
+    first_free = {}  # TopoNode -> no empty port before this one
+    for (a, b), latency in zip(edges, latencies):
+        a = topoOf(a)
+        b = topoOf(b)
+        assert a is not b
+        cable_types = a._cable_types(cable)
+
+        remotePort = b._free_port(True, first_free.get(b, 0))
+        first_free[b] = remotePort
+        localPort = a._free_port(True, first_free.get(a, 0))
+        first_free[a] = localPort
+
+        if a.gui_events:
+            gui_links.append((a.entity.name, localPort, b.entity.name, remotePort))
+
+        if cable_types[0] is not None:
+            c = a._make_cable(cable_types[0], latency, a, localPort, b, remotePort)
+            a._set_port(localPort, c)
+            ups.append((a.entity.handle_link_up, localPort, c.latency))
+
+        if cable_types[1] is not None:
+            c = a._make_cable(cable_types[1], latency, b, remotePort, a, localPort)
+            b._set_port(remotePort, c)
+            ups.append((b.entity.handle_link_up, remotePort, c.latency))
+
+        result.append((localPort, remotePort))
+
+    if gui_links:
+        world.doLater(0, events.send_links_up, gui_links)
+    if ups:
+        world.do(_links_up, ups)
+    return result
@@ -0,0 +1,197 @@
+"""
+Profiling for the simulator's event loop
+
+Turn it on with --profile=out.json on the commandline (or by calling
+sim.core.world.enable_profiling()).  For every kind of callback that the
+World dispatches (e.g., BasicCable.deliver), it keeps a count along with
+the total and maximum wall-clock time spent in it.  It also times some
+things which happen *inside* those callbacks: entities' handle_rx() and
+friends, each recurring timer, and every call to the event interface
+(e.g., events.packet).  So nested entries overlap with the entries for the
+callbacks they happened in.  Queue depth is sampled as the simulation
+goes.  The results are written as JSON when the process exits.
+"""
+
+from __future__ import print_function
+import atexit
+import json
+import time
+import types
+
+import sim.core as core
+
+
+def callback_name(f):
+    """
+    Returns a name like "BasicCable.deliver" for a callable
+    """
+    name = getattr(f, "profile_name", None)
+    if name is not None:
+        return name
+    s = getattr(f, "__self__", None)
+    if s is not None and not isinstance(s, types.ModuleType):
+        func = getattr(f, "__func__", None)
+        name = getattr(func, "__name__", None) or getattr(f, "__name__", "?")
+        return type(s).__name__ + "." + name
+    name = getattr(f, "__qualname__", None) or getattr(f, "__name__", None)
+    if name is None:
+        return type(f).__name__
+    return name
+
+
+class _Stat(object):
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class ProfiledInterface(object):
+    """
+    Wraps an event interface (e.g., a NullInterface) and times its methods
+    """
+
+    def __init__(self, interface, profiler):
+        self._interface = interface
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        attr = getattr(self._interface, name)
+        if not callable(attr) or name.startswith("__"):
+            return attr
+        attr = self._profiler.timed("events." + name, attr)
+        setattr(self, name, attr)  # Don't come through here next time
+        return attr
+
+
+class Profiler(object):
+    """
+    Collects timing for the World's event loop
+
+    You can also use record() or timed() to instrument your own hot spots.
+    """
+
+    # Sample the queue depth at most this often (simulated seconds)
+    SAMPLE_INTERVAL = 0.1
+
+    ENTITY_METHODS = ("handle_rx", "handle_link_up", "handle_link_down")
+
+    def __init__(self, world, filename=None):
+        self.world = world
+        self.filename = filename
+        self._inner = world._dispatch
+        self.stats = {}  # name -> _Stat
+        self.queue_depth = []  # (time, depth)
+        self.max_queue_depth = 0
+        self.dispatched = 0
+        self._last_sample = None
+        self._start = time.time()
+        self._start_time = world.time
+        if filename:
+            atexit.register(self.dump)
+
+    def record(self, name, elapsed):
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = _Stat()
+        stat.count += 1
+        stat.total += elapsed
+        if elapsed > stat.max:
+            stat.max = elapsed
+
+    def timed(self, name, f):
+        """Returns a version of f which records its time under name"""
+        record = self.record
+        clock = time.time
+
+        def timed_f(*args, **kw):
+            start = clock()
+            try:
+                return f(*args, **kw)
+            finally:
+                record(name, clock() - start)
+
+        timed_f.profile_name = name
+        return timed_f
+
+    def wrap_entity(self, entity):
+        """Times the entity's event handlers (by overriding them on it)"""
+        for m in self.ENTITY_METHODS:
+            f = getattr(entity, m, None)
+            if f is None:
+                continue
+            setattr(entity, m, self.timed(callback_name(f), f))
+
+    def dispatch(self, o):
+        """
+        Dispatches an event the way the World would have, but times it
+
+        World.enable_profiling() puts this in place of World._dispatch.
+        """
+        world = self.world
+        f = o[2]
+        if f is core._catch and o[3]:
+            f = o[3][0]
+        if hasattr(f, "profile_name"):
+            # Already timed (e.g., an entity's handle_link_up())
+            self._inner(o)
+        else:
+            start = time.time()
+            self._inner(o)
+            self.record(callback_name(f), time.time() - start)
+        self.dispatched += 1
+
+        t = world.time
+        if self._last_sample is None or t - self._last_sample >= self.SAMPLE_INTERVAL:
+            self._last_sample = t
+            depth = len(world.queue)
+            self.queue_depth.append((t - self._start_time, depth))
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+
+    def fire_timer(self, timer):
+        """Runs a timer from a TimerWheel slot, timing it"""
+        name = "Timer:" + callback_name(timer.func)
+        start = time.time()
+        timer.timeout()
+        self.record(name, time.time() - start)
+
+    def results(self):
+        callbacks = {}
+        for name, stat in self.stats.items():
+            callbacks[name] = dict(
+                count=stat.count,
+                total=stat.total,
+                max=stat.max,
+                mean=stat.total / stat.count if stat.count else 0,
+            )
+        return dict(
+            wall_time=time.time() - self._start,
+            sim_time=self.world.time - self._start_time,
+            dispatched=self.dispatched,
+            max_queue_depth=self.max_queue_depth,
+            callbacks=callbacks,
+            queue_depth=self.queue_depth,
+        )
+
+    def dump(self, filename=None):
+        filename = filename or self.filename
+        with open(filename, "w") as f:
+            json.dump(self.results(), f, indent=2, sort_keys=True)
+
+    def report(self, limit=20):
+        """Returns a text summary of where the time went"""
+        r = self.results()
+        lines = [
+            "%s events dispatched in %.3fs (%.3f simulated)"
+            % (r["dispatched"], r["wall_time"], r["sim_time"])
+        ]
+        items = sorted(r["callbacks"].items(), key=lambda kv: -kv[1]["total"])
+        for name, s in items[:limit]:
+            lines.append(
+                "%10i %10.4fs %10.6fs max  %s"
+                % (s["count"], s["total"], s["max"], name)
+            )
+        return "\n".join(lines)
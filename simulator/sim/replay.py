@@ -0,0 +1,194 @@
+"""
+Recording and replaying simulations
+
+A recording is a compact binary log of the things a simulation did which
+can't be reproduced just by setting it up the same way again:
+
+ * when each event was actually dispatched (in real time, the clock has
+   moved on a bit from when the event was due)
+ * every number drawn from the Simulation's random number generator
+   (core.rand(), which is used for seeding cables; packet colors come from
+   a separate generator, so whether a GUI is looking doesn't matter)
+
+To make real-time runs replayable, the Recorder makes the clock stand still
+while an event runs (i.e., api.current_time() returns the time the event
+was dispatched), and only batches together events due at exactly the same
+time, as virtual time does.  Before the simulation starts, the clock is
+stopped at the time the Recorder was set up.
+
+To replay, set up the same simulation (same modules and arguments) with
+--replay=file.  It runs in virtual time, taking the clock and the random
+numbers from the log, so it runs as fast as the CPU allows.  With
+--replay-until=N, it stops after N events, so you can bisect your way to
+where things go wrong.  The due time of every event is checked against the
+log; if they don't match, the replay has diverged, and it stops with a
+ReplayDivergence.
+
+Things which can't be replayed: input from NetVis or the console, your
+own use of the random module, and the iteration order of sets and dicts
+keyed on things which hash by identity (like Entities).
+"""
+
+import atexit
+import struct
+import threading
+
+import sim.core as core
+
+MAGIC = b"SIMREC\x00\x01"
+
+_header = struct.Struct("<dd")  # Clock before start, TimerWheel resolution
+_start = struct.Struct("<cd")  # b"S", start time
+_event = struct.Struct("<cdd")  # b"E", due time, dispatch time
+_draw = struct.Struct("<cd")  # b"R", random number
+
+
+class ReplayDivergence(RuntimeError):
+    pass
+
+
+class Recorder(object):
+    """
+    Records a World's events and random numbers to a file
+    """
+
+    def __init__(self, world, filename):
+        self.world = world
+        self.filename = filename
+        self._file = open(filename, "wb")
+        self._real = not world.virtual_time
+        self._started = False
+        self._frozen = None
+
+        t0 = world.time
+        self._file.write(MAGIC + _header.pack(t0, world.timers.resolution))
+
+        if self._real:
+            self._frozen = t0
+            world._get_time = self.get_time
+        world._exact_batches = True
+        world._start_time = self.start_time
+        self._inner = world._dispatch
+        world._dispatch = self.dispatch
+
+        simulation = world.simulation
+        self._random = simulation.random
+        simulation.random = self.random
+        if core.current is simulation:
+            simulation.activate()
+
+        atexit.register(self.close)
+
+    def get_time(self):
+        t = self._frozen
+        if t is not None:
+            if not self._started or threading.current_thread() is self.world._thread:
+                return t
+        return self.world._get_time_real()
+
+    def start_time(self):
+        self._started = True
+        self._frozen = None
+        t = self.world.time
+        self._file.write(_start.pack(b"S", t))
+        return t
+
+    def dispatch(self, o):
+        t = self.world.time
+        self._file.write(_event.pack(b"E", o[0], t))
+        if not self._real:
+            self._inner(o)
+            return
+        self._frozen = t
+        try:
+            self._inner(o)
+        finally:
+            self._frozen = None
+
+    def random(self):
+        v = self._random()
+        self._file.write(_draw.pack(b"R", v))
+        return v
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class Replayer(object):
+    """
+    Replays a recording made by a Recorder
+    """
+
+    def __init__(self, world, filename, until=None):
+        self.world = world
+        self.until = until
+        self.events = []  # (due time, dispatch time)
+        self.draws = []
+        self.start = None
+        self._next_event = 0
+        self._next_draw = 0
+
+        with open(filename, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise RuntimeError("%s is not a simulator recording" % (filename,))
+        offset = len(MAGIC)
+        t0, resolution = _header.unpack_from(data, offset)
+        offset += _header.size
+        while offset < len(data):
+            kind = data[offset : offset + 1]
+            if kind == b"E":
+                _, due, t = _event.unpack_from(data, offset)
+                self.events.append((due, t))
+                offset += _event.size
+            elif kind == b"R":
+                self.draws.append(_draw.unpack_from(data, offset)[1])
+                offset += _draw.size
+            elif kind == b"S":
+                self.start = _start.unpack_from(data, offset)[1]
+                offset += _start.size
+            else:
+                raise RuntimeError("Corrupt recording at byte %s" % (offset,))
+
+        world.virtual_time = True
+        world.timers.resolution = resolution
+        world._time = t0
+        world._start_time = self.start_time
+        self._inner = world._dispatch
+        world._dispatch = self.dispatch
+
+        simulation = world.simulation
+        simulation.random = self.random
+        if core.current is simulation:
+            simulation.activate()
+
+    def start_time(self):
+        if self.start is not None:
+            self.world._time = self.start
+        return self.world._time
+
+    def dispatch(self, o):
+        world = self.world
+        i = self._next_event
+        if i >= len(self.events) or (self.until is not None and i >= self.until):
+            core.simlog.info("Replay stopped after %s events", i)
+            world.stop()
+            return
+        due, t = self.events[i]
+        if o[0] != due:
+            raise ReplayDivergence(
+                "Replay diverged at event %s (%s): due at %r, but recorded at %r"
+                % (i, o[2], o[0], due)
+            )
+        self._next_event = i + 1
+        if t > world._time:
+            world._time = t
+        self._inner(o)
+
+    def random(self):
+        i = self._next_draw
+        if i >= len(self.draws):
+            raise ReplayDivergence("Replay used more random numbers than recorded")
+        self._next_draw = i + 1
+        return self.draws[i]
@@ -0,0 +1,19 @@
+"""
+Tests for the simulator
+
+Run them from the simulator directory with either of:
+  python -m pytest tests
+  python -m unittest discover -s tests -t .
+
+Importing this package sets the simulator up to run without a GUI, a
+console or the wall clock, so Worlds made by the tests run as fast as
+the CPU allows.
+"""
+
+import sim
+
+sim.config.remote_interface = "none"
+sim.config.interactive = False
+sim.config.console_log = False
+sim.config.virtual_time = True
+sim.config.headless = True
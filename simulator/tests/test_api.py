@@ -0,0 +1,77 @@
+import unittest
+
+import tests  # Sets up sim.config
+import sim.api as api
+import sim.basics as basics
+import sim.core as core
+from cs168.dv import RoutePacket
+
+
+class SlottedPacket(api.Packet):
+    __slots__ = ("n",)
+
+
+class TestPacketFields(unittest.TestCase):
+    def setUp(self):
+        core.World()
+
+    def test_ad_hoc_fields(self):
+        p = api.Packet()
+        p.payload = 1
+        self.assertEqual(p.payload, 1)
+
+        r = RoutePacket(destination=None, latency=3)
+        r.foo = 1
+        self.assertEqual((r.foo, r.latency), (1, 3))
+
+        s = SlottedPacket()
+        s.n = 1
+        s.extra = 2
+        self.assertEqual((s.n, s.extra), (1, 2))
+
+    def test_copies_keep_fields(self):
+        p = SlottedPacket()
+        p.n = 5
+        p.extra = "x"
+        p.items = [1, 2]
+        dup = core._duplicate_packet(p)
+        self.assertEqual((dup.n, dup.extra, dup.items), (5, "x", [1, 2]))
+        dup.items.append(3)
+        self.assertEqual(p.items, [1, 2])
+
+    def test_flooded_copies_keep_fields(self):
+        got = []
+
+        class Receiver(basics.BasicHost):
+            ENABLE_DISCOVERY = False
+
+            def handle_rx(self, packet, port):
+                if isinstance(packet, basics.Ping):
+                    got.append((self.name, packet.payload, packet.outer_color))
+
+        w = core.world
+        a = basics.BasicHost.create("a")
+        for name in ("b", "c"):
+            a.linkTo(Receiver.create(name))
+        p = basics.Ping(None)
+        p.payload = {"k": 1}
+        w.doLater(1, a.send, p, flood=True)
+        w.run_until(5)
+        self.assertEqual(sorted(g[:2] for g in got), [("b", {"k": 1}), ("c", {"k": 1})])
+        self.assertEqual(got[0][2], got[1][2])  # Same color for every copy
+
+    def test_colors_leave_rand_alone(self):
+        # Whether a GUI reads colors mustn't change the simulation's numbers
+        sim = core.current
+        sim.rng.seed(1)
+        expected = [core.rand() for _ in range(3)]
+        sim.rng.seed(1)
+        p = api.Packet()
+        p.outer_color
+        core._duplicate_packet(p).outer_color
+        api.Packet().outer_color
+        self.assertEqual([core.rand() for _ in range(3)], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+import unittest
+
+import tests  # Sets up sim.config
+import sim
+import sim.api as api
+import sim.core as core
+from sim.cable import BasicCable, PriorityCable, QueuedCable, REDCable
+
+
+class Sink(api.Entity):
+    def __init__(self):
+        self.got = []
+        self.times = []
+
+    def handle_rx(self, packet, port):
+        self.got.append(packet)
+        self.times.append(api.current_time())
+
+
+class Data(api.Packet):
+    PRIORITY = 1
+
+
+class Control(api.Packet):
+    PRIORITY = 0
+
+
+def _link(cls, name="a", **kw):
+    """Makes a World with a cls(**kw) link from a new entity to a Sink"""
+    w = core.World()
+    cable = cls(**kw)
+    a = api.Entity.create(name)
+    b = Sink.create(name + "_sink")
+    a.linkTo(b, (cable, None))
+    return w, a, b, cable
+
+
+def _burst(w, a, packets, at=1):
+    def send():
+        for p in packets:
+            a.send(p, port=0)
+
+    w.doLater(at, send)
+
+
+def _numbered(n, start=0):
+    packets = [Data() for _ in range(n)]
+    for i, p in enumerate(packets):
+        p.n = start + i
+    return packets
+
+
+def _pending_deliveries(w, cable):
+    return [ev for ev in w.queue._heap if not ev.cancelled and ev[2] == cable.deliver]
+
+
+class TestQueuedCable(unittest.TestCase):
+    def test_default_queue_size(self):
+        w, a, b, c = _link(QueuedCable)
+        self.assertEqual(c.size, QueuedCable.DEFAULT_QUEUE_SIZE)
+        _burst(w, a, [Data() for _ in range(500)])
+        w.run_until(100)
+        # One goes right away and 100 wait; the rest don't fit
+        self.assertEqual(c.drops, 500 - 101)
+        self.assertEqual(len(b.got), 101)
+
+    def test_unbounded_queue(self):
+        w, a, b, c = _link(QueuedCable, queue_size=None)
+        self.assertIsNone(c.size)
+        _burst(w, a, [Data() for _ in range(500)])
+        w.run_until(100)
+        self.assertEqual(c.drops, 0)
+        self.assertEqual(len(b.got), 500)
+        self.assertEqual(c.queue_max, 499)
+
+    def test_subclasses_default_and_unbounded(self):
+        core.World()
+        for cls in (REDCable, PriorityCable):
+            self.assertEqual(cls().size, QueuedCable.DEFAULT_QUEUE_SIZE)
+            self.assertIsNone(cls(queue_size=None).size)
+
+
+class TestREDCable(unittest.TestCase):
+    def setUp(self):
+        self._cable_seed = sim.config.cable_seed
+        sim.config.cable_seed = "test"
+
+    def tearDown(self):
+        sim.config.cable_seed = self._cable_seed
+
+    def _run(self, other_traffic):
+        """
+        Sends bursts over a RED cable and returns which packets got through
+
+        If other_traffic, another RED cable in the same World is busy too.
+        Also returns the next number from the Simulation's generator.
+        """
+        w, a, b, c = _link(REDCable, bandwidth=1e6, weight=0.2)
+        w.simulation.rng.seed(1)
+        if other_traffic:
+            x = api.Entity.create("x")
+            y = Sink.create("y")
+            x.linkTo(y, (REDCable(bandwidth=1e6, weight=0.2), None))
+            for i in range(5):
+                _burst(w, x, [Data() for _ in range(40)], at=1 + i)
+        for i in range(5):
+            packets = [Data() for _ in range(40)]
+            for n, p in enumerate(packets):
+                p.n = (i, n)
+            _burst(w, a, packets, at=1 + i)
+        w.run_until(100)
+        self.assertTrue(c.early_drops)
+        return [p.n for p in b.got], w.simulation.rng.random()
+
+    def test_own_random_stream(self):
+        quiet, quiet_draw = self._run(False)
+        busy, busy_draw = self._run(True)
+        # The other cable's early drops don't change this one's ...
+        self.assertEqual(quiet, busy)
+        # ... or use up the Simulation's random numbers
+        self.assertEqual(quiet_draw, busy_draw)
+
+    def test_seed(self):
+        w, a, b, c = _link(REDCable, seed=5)
+        w2, a2, b2, c2 = _link(REDCable, seed=5)
+        self.assertEqual(c.rng.random(), c2.rng.random())
+
+
+class TestPriorityCable(unittest.TestCase):
+    def test_drops_by_class(self):
+        w, a, b, c = _link(PriorityCable, queue_size=2)
+        # The first packet is sent right away; then 2 of each class wait
+        packets = [Data() for _ in range(5)] + [Control() for _ in range(3)]
+        _burst(w, a, packets)
+        w.run_until(1)
+        self.assertEqual(c.drops_by_class, [1, 2])
+        self.assertEqual(c.drops, 3)
+
+        # Asking whether it's full doesn't count as a drop
+        self.assertTrue(c._is_full(Data()))
+        self.assertTrue(c._is_full(Control()))
+        self.assertEqual(c.drops_by_class, [1, 2])
+
+        w.run_until(100)
+        self.assertEqual(c.tx_packets_by_class, [2, 3])
+        # Control traffic goes before the data which was waiting
+        self.assertEqual([type(p) for p in b.got], [Data, Control, Control, Data, Data])
+
+
+class TestBasicCable(unittest.TestCase):
+    def test_latency_lowered_mid_run(self):
+        w, a, b, c = _link(BasicCable, latency=5)
+        _burst(w, a, _numbered(3), at=1)
+        w.doLater(1.5, setattr, c, "latency", 0.5)
+        _burst(w, a, _numbered(3, 3), at=2)
+        w.doLater(2.1, lambda: self.assertFalse(c._fifo))  # Using the heap
+        w.run_until(100)
+        # The later packets overtake the ones still on the wire
+        self.assertEqual([p.n for p in b.got], [3, 4, 5, 0, 1, 2])
+        self.assertEqual(b.times, sorted(b.times))
+        self.assertEqual([round(t, 6) for t in b.times], [2.6, 2.7, 2.8, 6.1, 6.2, 6.3])
+        self.assertTrue(c._fifo)  # Back to a deque once it emptied
+        self.assertEqual(len(c.queue), 0)
+
+    def test_tail_drop_in_heap_mode(self):
+        w, a, b, c = _link(BasicCable, latency=5, queue_size=3)
+        _burst(w, a, _numbered(2), at=1)
+        w.doLater(1.5, setattr, c, "latency", 0.5)
+        # Packet 2 goes ahead of 0 and 1, so it's a heap.  Then the queue is
+        # full, so 3 and 4 get dropped, even though they'd be due before 0.
+        _burst(w, a, _numbered(3, 2), at=2)
+        w.doLater(2.1, lambda: self.assertFalse(c._fifo))
+        w.run_until(100)
+        self.assertEqual([p.n for p in b.got], [2, 0, 1])
+        self.assertEqual(c.drops, 2)
+
+    def test_one_pending_delivery(self):
+        w, a, b, c = _link(BasicCable, latency=1)
+        counts = []
+
+        def check():
+            pending = _pending_deliveries(w, c)
+            counts.append(len(pending))
+            if pending:
+                self.assertEqual(pending[0][0], c.queue[0][0])
+                self.assertEqual(pending[0][0], c.next_delivery)
+
+        _burst(w, a, _numbered(50), at=1)
+        for t in (1, 2, 3.05, 5.95, 7.5, 9):
+            w.doLater(t, check)
+        w.doLater(9.5, setattr, c, "latency", 5)
+        _burst(w, a, _numbered(5, 50), at=10)
+        w.doLater(10, check)
+        # A packet which overtakes the rest moves the delivery event earlier
+        w.doLater(10.5, setattr, c, "latency", 0.01)
+        _burst(w, a, _numbered(1, 55), at=11)
+        w.doLater(11, check)
+        w.doLater(12, check)
+        w.run_until(100)
+        check()
+        # Pending while packets were queued, none once it drained, and then
+        # one again after it refilled
+        self.assertEqual(counts, [1, 1, 1, 1, 0, 0, 1, 1, 1, 0])
+        expected = list(range(50)) + [55] + list(range(50, 55))
+        self.assertEqual([p.n for p in b.got], expected)
+        self.assertIsNone(c.next_delivery)
+
+
+if __name__ == "__main__":
+    unittest.main()
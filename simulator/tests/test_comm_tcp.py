@@ -0,0 +1,87 @@
+import threading
+import unittest
+
+import tests  # Sets up sim.config
+import sim
+import sim.api as api
+import sim.core as core
+from sim.comm_tcp import PacketBatcher
+
+
+class FakeInterface(object):
+    def __init__(self):
+        self.sent = []
+        self.got = threading.Event()
+
+    def send(self, msg, connections=None, droppable=False):
+        self.sent.append(msg)
+        self.got.set()
+
+
+class TestPacketBatcher(unittest.TestCase):
+    def setUp(self):
+        core.World()
+        self.interface = FakeInterface()
+
+    def batch(self, batcher, packets):
+        for n1, n2 in packets:
+            batcher.add(n1, n2, api.Packet(), 1.0)
+        self.assertTrue(self.interface.got.wait(5))
+        (msg,) = self.interface.sent
+        self.assertEqual(msg["type"], "packets")
+        return msg["packets"]
+
+    def test_busy_link_is_one_entry(self):
+        batcher = PacketBatcher(self.interface, rate=10, max_links=5)
+        entries = self.batch(batcher, [("a", "b")] * 1000 + [("b", "a")] * 3)
+        counts = sorted((e["node1"], e["node2"], e["count"]) for e in entries)
+        self.assertEqual(counts, [("a", "b", 1000), ("b", "a", 3)])
+        self.assertEqual(batcher.dropped, 0)
+
+    def test_link_cap(self):
+        batcher = PacketBatcher(self.interface, rate=10, max_links=5)
+        links = [("a", "h%d" % i) for i in range(8)]
+        entries = self.batch(batcher, links * 2)
+        self.assertEqual(len(entries), 5)
+        self.assertEqual([e["count"] for e in entries], [2] * 5)
+        self.assertEqual(batcher.dropped, 6)  # Both packets on 3 links
+
+    def test_cap_boundary(self):
+        for n in (4, 5, 6):
+            self.interface.sent = []
+            self.interface.got.clear()
+            batcher = PacketBatcher(self.interface, rate=10, max_links=5)
+            links = [("a", "h%d" % i) for i in range(n)]
+            entries = self.batch(batcher, links)
+            self.assertEqual(len(entries), min(n, 5))
+            self.assertEqual(batcher.dropped, max(0, n - 5))
+
+        batcher = PacketBatcher(self.interface, rate=10, max_links=1)
+        self.assertEqual(batcher.max_links, 1)
+        with self.assertRaises(ValueError):
+            PacketBatcher(self.interface, rate=10, max_links=-1)
+
+    def test_no_cap(self):
+        old = sim.config.max_animated_links
+        sim.config.max_animated_links = None
+        try:
+            batcher = PacketBatcher(self.interface, rate=10)
+        finally:
+            sim.config.max_animated_links = old
+        links = [("a", "h%d" % i) for i in range(200)]
+        self.assertEqual(len(self.batch(batcher, links)), 200)
+
+    def test_explicit_no_cap(self):
+        self.assertEqual(sim.config.max_animated_links, 50)
+        for max_links in (None, 0):
+            self.interface.sent = []
+            self.interface.got.clear()
+            batcher = PacketBatcher(self.interface, rate=10, max_links=max_links)
+            self.assertIsNone(batcher.max_links)
+            links = [("a", "h%d" % i) for i in range(200)]
+            self.assertEqual(len(self.batch(batcher, links)), 200)
+            self.assertEqual(batcher.dropped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,326 @@
+import json
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import unittest
+
+import tests  # Sets up sim.config
+import sim.comm_web as comm_web
+
+INDEX_HTML = os.path.join(
+    os.path.dirname(__file__), "..", "..", "netvis", "NetVis", "index.html"
+)
+
+
+def decode_binary(buf):
+    """
+    Decodes a binary NetVis message
+
+    This follows decodeBinary() in NetVis's index.html step for step, so
+    it's the layout NetVis actually reads.
+    """
+    kind = buf[0]
+    off = 1
+    (name_count,) = struct.unpack_from("<H", buf, off)
+    off += 2
+    names = []
+    for _ in range(name_count):
+        (n,) = struct.unpack_from("<H", buf, off)
+        off += 2
+        names.append(buf[off : off + n].decode("utf8"))
+        off += n
+    (count,) = struct.unpack_from("<I", buf, off)
+    off += 4
+
+    def color(o):
+        return [(b + 0.5) / 255 for b in buf[o : o + 4]]
+
+    if kind == 1:
+        packets = []
+        for _ in range(count):
+            n1, n2, duration, n = struct.unpack_from("<HHfI", buf, off)
+            packets.append(
+                dict(
+                    node1=names[n1],
+                    node2=names[n2],
+                    duration=duration,
+                    count=n,
+                    stroke=color(off + 12),
+                    fill=color(off + 16),
+                    drop=buf[off + 20] != 0,
+                )
+            )
+            off += 21
+        assert off == len(buf)
+        return [dict(type="packets", packets=packets)]
+
+    links = []
+    for _ in range(count):
+        n1, p1, n2, p2 = struct.unpack_from("<HHHH", buf, off)
+        links.append([names[n1], p1, names[n2], p2])
+        off += 8
+    assert off == len(buf)
+    if kind == 2:
+        return [dict(type="links", links=links)]
+    if kind == 3:
+        return [
+            dict(type="unlink", node1=a, node1_port=A, node2=b, node2_port=B)
+            for a, A, b, B in links
+        ]
+    raise ValueError("Unknown binary message kind %s" % (kind,))
+
+
+def _packet(n1, n2, **kw):
+    p = dict(
+        node1=n1,
+        node2=n2,
+        duration=1000.0,
+        stroke=[1, 0, 1, 1],
+        fill=[0, 0, 0, 0],
+        drop=False,
+    )
+    p.update(kw)
+    return p
+
+
+MESSAGES = [
+    dict(
+        type="packets",
+        packets=[
+            _packet("s1", "hé", count=7, fill=(0.2, 0.4, 0.6)),
+            _packet("hé", "s1", duration=250.5, stroke=None, drop=True),
+            _packet("s1", "s2", count=100000, stroke=[2, -1, 0.5, 1]),
+        ],
+    ),
+    dict(type="packet", **_packet("a", "b", duration=500.0)),
+    dict(type="links", links=[["a", 0, "b", 3], ["b", 1, "c", 0], ["c", 9, "a", 2]]),
+    dict(type="link", node1="x", node1_port=2, node2="y", node2_port=5),
+    dict(type="unlink", node1="x", node1_port=2, node2="y", node2_port=5),
+]
+
+
+class TestBinaryEncoding(unittest.TestCase):
+    def assertColor(self, decoded, color, default):
+        if color is None:
+            color = default
+        color = [min(1, max(0, c)) for c in color] + [1] * (4 - len(color))
+        for d, c in zip(decoded, color):
+            self.assertAlmostEqual(d, c, delta=1.0 / 255)
+
+    def check_packets(self, decoded, entries):
+        self.assertEqual(len(decoded), len(entries))
+        for d, e in zip(decoded, entries):
+            self.assertEqual(
+                (d["node1"], d["node2"], d["duration"], d["count"], d["drop"]),
+                (e["node1"], e["node2"], e["duration"], e.get("count", 1), e["drop"]),
+            )
+            self.assertColor(d["stroke"], e["stroke"], [1, 1, 1, 1])
+            self.assertColor(d["fill"], e["fill"], [0, 0, 0, 0])
+
+    def test_packets(self):
+        msg = MESSAGES[0]
+        (decoded,) = decode_binary(comm_web.encode_binary(msg))
+        self.assertEqual(decoded["type"], "packets")
+        self.check_packets(decoded["packets"], msg["packets"])
+
+    def test_packet(self):
+        msg = MESSAGES[1]
+        (decoded,) = decode_binary(comm_web.encode_binary(msg))
+        self.assertEqual(decoded["type"], "packets")
+        self.check_packets(decoded["packets"], [msg])
+
+    def test_links(self):
+        msg = MESSAGES[2]
+        decoded = decode_binary(comm_web.encode_binary(msg))
+        self.assertEqual(decoded, [msg])
+
+    def test_link(self):
+        decoded = decode_binary(comm_web.encode_binary(MESSAGES[3]))
+        self.assertEqual(decoded, [dict(type="links", links=[["x", 2, "y", 5]])])
+
+    def test_unlink(self):
+        msg = MESSAGES[4]
+        self.assertEqual(decode_binary(comm_web.encode_binary(msg)), [msg])
+
+    def test_names_are_shared(self):
+        msg = dict(type="links", links=[["a", i, "b", i] for i in range(100)])
+        data = comm_web.encode_binary(msg)
+        self.assertEqual(len(data), 1 + 2 + 2 * 3 + 4 + 100 * 8)
+
+    def test_other_kinds_are_json(self):
+        for msg in (dict(type="info", text="hi"), dict(type="initialize")):
+            self.assertIsNone(comm_web.encode_binary(msg))
+
+    def test_falls_back_to_json(self):
+        bad = [
+            # A name which is too long for the name table
+            dict(type="links", links=[["a" * 70000, 0, "b", 0]]),
+            dict(
+                type="unlink", node1="b", node1_port=0, node2="é" * 40000, node2_port=1
+            ),
+            # Too many names
+            dict(
+                type="links", links=[["n%d" % i, 0, "m%d" % i, 0] for i in range(40000)]
+            ),
+            # A port which doesn't fit
+            dict(type="links", links=[["a", 70000, "b", 0]]),
+            # Missing fields
+            dict(type="packets", packets=[dict(node1="a")]),
+        ]
+        for msg in bad:
+            self.assertIsNone(comm_web.encode_binary(msg))
+            frame = comm_web.WebInterface._encode(None, msg, "binary")
+            self.assertEqual(frame[0] & 0x0F, comm_web.WebHandler.WS_TEXT)
+
+    @unittest.skipUnless(shutil.which("node"), "needs node")
+    def test_netvis_decoder(self):
+        """Decodes every kind of message with NetVis's own decodeBinary()"""
+        with open(INDEX_HTML) as f:
+            html = f.read()
+        decoder = re.search(r"function decodeBinary .*?\n}\n", html, re.S).group(0)
+        encoded = [comm_web.encode_binary(m).hex() for m in MESSAGES]
+        script = decoder + (
+            "const out = %s.map(function (h) {\n"
+            "  const b = Buffer.from(h, 'hex');\n"
+            "  return decodeBinary(b.buffer.slice(b.byteOffset,"
+            " b.byteOffset + b.length));\n"
+            "});\n"
+            "console.log(JSON.stringify(out));\n" % (json.dumps(encoded),)
+        )
+        out = subprocess.check_output(["node", "-e", script])
+        expected = [decode_binary(bytes.fromhex(h)) for h in encoded]
+        self.assertEqual(json.loads(out), json.loads(json.dumps(expected)))
+
+
+def _frame(op, payload, fin=True, mask=b"\x12\x34\x56\x78"):
+    """Makes a masked frame, the way a client would"""
+    b0 = (0x80 if fin else 0) | op
+    n = len(payload)
+    if n <= 125:
+        header = struct.pack("!BB", b0, 0x80 | n)
+    elif n <= 0xFFFF:
+        header = struct.pack("!BBH", b0, 0x80 | 126, n)
+    else:
+        header = struct.pack("!BBQ", b0, 0x80 | 127, n)
+    masked = bytes(bytearray(c ^ mask[i % 4] for i, c in enumerate(payload)))
+    return header + mask + masked
+
+
+class TestWebSocketDeframer(unittest.TestCase):
+    TEXT = comm_web.WebHandler.WS_TEXT
+    BINARY = comm_web.WebHandler.WS_BINARY
+    CLOSE = comm_web.WebHandler.WS_CLOSE
+    PING = comm_web.WebHandler.WS_PING
+    CONTINUE = comm_web.WebSocketDeframer.WS_CONTINUE
+
+    def setUp(self):
+        self.got = []
+        self.deframer = comm_web.WebSocketDeframer(
+            lambda op, payload: self.got.append((op, payload))
+        )
+        self.rng = random.Random(0)
+
+    def payload(self, n):
+        return bytes(bytearray(self.rng.getrandbits(8) for _ in range(n)))
+
+    def feed(self, data, chunk_size):
+        for i in range(0, len(data), chunk_size):
+            self.deframer.feed(data[i : i + chunk_size])
+
+    def test_lengths(self):
+        # 7-bit, 16-bit (126 up to 65535) and 64-bit (65536 and up) lengths
+        for n in (0, 1, 125, 126, 127, 1000, 65535, 65536, 100000):
+            del self.got[:]
+            data = self.payload(n)
+            self.deframer.feed(_frame(self.BINARY, data))
+            self.assertEqual(self.got, [(self.BINARY, data)], n)
+            self.assertEqual(len(self.deframer._buf), 0)
+
+    def test_split_anywhere(self):
+        messages = [self.payload(n) for n in (0, 5, 125, 126, 300, 65536)]
+        stream = b"".join(_frame(self.TEXT, m) for m in messages)
+        expected = [(self.TEXT, m) for m in messages]
+        for chunk_size in (1, 2, 3, 5, 9, 11, 4096, len(stream)):
+            del self.got[:]
+            self.feed(stream, chunk_size)
+            self.assertEqual(self.got, expected, chunk_size)
+            self.assertEqual(len(self.deframer._buf), 0)
+
+    def test_header_split(self):
+        frame = _frame(self.TEXT, b"x" * 70000)
+        for cut in range(1, 14):  # Inside the 64-bit length and the mask
+            del self.got[:]
+            self.deframer.feed(frame[:cut])
+            self.assertEqual(self.got, [])
+            self.assertEqual(bytes(self.deframer._buf), frame[:cut])
+            self.deframer.feed(frame[cut:])
+            self.assertEqual(self.got, [(self.TEXT, b"x" * 70000)])
+
+    def test_several_frames_in_one_feed(self):
+        stream = _frame(self.TEXT, b"a") + _frame(self.TEXT, b"bc") + b"\x81"
+        self.deframer.feed(stream)
+        self.assertEqual(self.got, [(self.TEXT, b"a"), (self.TEXT, b"bc")])
+        self.assertEqual(bytes(self.deframer._buf), b"\x81")
+
+    def test_fragments_with_control_frames(self):
+        big = self.payload(1000)
+        stream = (
+            _frame(self.TEXT, b"abc", fin=False)
+            + _frame(self.PING, b"p1")
+            + _frame(self.CONTINUE, big, fin=False)
+            + _frame(self.PING, b"")
+            + _frame(self.CONTINUE, b"ghi")
+            + _frame(self.BINARY, b"after")
+            + _frame(self.CLOSE, b"")
+        )
+        for chunk_size in (1, 7, len(stream)):
+            del self.got[:]
+            self.feed(stream, chunk_size)
+            self.assertEqual(
+                self.got,
+                [
+                    (self.PING, b"p1"),
+                    (self.PING, b""),
+                    (self.TEXT, b"abc" + big + b"ghi"),
+                    (self.BINARY, b"after"),
+                    (self.CLOSE, b""),
+                ],
+            )
+
+    def test_masks(self):
+        data = self.payload(1001)  # Not a multiple of four
+        for mask in (b"\x00\x00\x00\x00", b"\xff\xff\xff\xff", b"\x01\x80\x7f\xfe"):
+            del self.got[:]
+            self.deframer.feed(_frame(self.BINARY, data, mask=mask))
+            self.assertEqual(self.got, [(self.BINARY, data)])
+
+    def test_unmask(self):
+        mask = b"\xa1\xb2\xc3\xd4"
+        for n in range(0, 10):
+            data = self.payload(n)
+            expected = bytes(bytearray(c ^ mask[i % 4] for i, c in enumerate(data)))
+            self.assertEqual(comm_web._unmask(data, mask), expected)
+            self.assertEqual(comm_web._unmask(expected, mask), data)
+        self.assertEqual(comm_web._unmask(b"", mask), b"")
+        self.assertEqual(comm_web._unmask(memoryview(b"\x00" * 4), mask), mask)
+
+    def test_bad_frames(self):
+        unmasked = b"\x81\x05hello"
+        bad = [
+            unmasked,
+            _frame(self.PING, b"x", fin=False),  # Fragmented control frame
+            _frame(self.CONTINUE, b"x"),  # Nothing to continue
+            # A new message before the last one was finished
+            _frame(self.TEXT, b"a", fin=False) + _frame(self.TEXT, b"b"),
+        ]
+        for data in bad:
+            deframer = comm_web.WebSocketDeframer(lambda op, payload: None)
+            with self.assertRaises(RuntimeError):
+                deframer.feed(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,600 @@
+import threading
+import time
+import unittest
+
+import tests  # Sets up sim.config
+import sim.api as api
+import sim.basics as basics
+import sim.core as core
+from sim.cable import BasicCable, UnreliableCable
+
+
+def _f():
+    pass
+
+
+class TestEventQueue(unittest.TestCase):
+    def setUp(self):
+        self.q = core.EventQueue()
+
+    def pop_due(self, t):
+        with self.q.cv:
+            return self.q.pop_due(t)
+
+    def test_fifo_at_equal_times(self):
+        evs = [self.q.push(1.0, _f, (i,), {}) for i in range(200)]
+        self.q.push(0.5, _f, ("early",), {})
+        self.q.push(2.0, _f, ("late",), {})
+        due = self.pop_due(1.0)
+        self.assertEqual([ev[3] for ev in due], [("early",)] + [ev[3] for ev in evs])
+        self.assertEqual(len(self.q), 1)
+
+    def test_fifo_across_interleaved_times(self):
+        for i in range(100):
+            self.q.push(float(i % 3), _f, (i,), {})
+        due = self.pop_due(10)
+        order = [ev[3][0] for ev in due]
+        expected = sorted(range(100), key=lambda i: (i % 3, i))
+        self.assertEqual(order, expected)
+
+    def test_cancel_before_compaction(self):
+        evs = [self.q.push(float(i), _f, (i,), {}) for i in range(10)]
+        evs[3].cancel()
+        evs[3].cancel()  # A second cancel does nothing
+        self.assertTrue(evs[3].cancelled)
+        self.assertEqual(self.q.stats(), dict(live=9, dead=1, compactions=0))
+        due = self.pop_due(100)
+        self.assertEqual([ev[3][0] for ev in due], [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(self.q.stats(), dict(live=0, dead=0, compactions=0))
+
+    def test_cancel_at_head_is_skipped_by_peek(self):
+        evs = [self.q.push(float(i), _f, (i,), {}) for i in range(3)]
+        evs[0].cancel()
+        with self.q.cv:
+            self.assertIs(self.q.peek(), evs[1])
+        self.assertEqual(self.q.stats(), dict(live=2, dead=0, compactions=0))
+
+    def test_compaction(self):
+        n = 200
+        evs = [self.q.push(float(i), _f, (i,), {}) for i in range(n)]
+        for ev in evs[: n // 2]:
+            ev.cancel()
+        self.assertEqual(self.q.stats()["compactions"], 0)
+        self.assertEqual(self.q.stats()["dead"], n // 2)
+        evs[n // 2].cancel()  # Now more than half are dead
+        self.assertEqual(self.q.stats(), dict(live=n // 2 - 1, dead=0, compactions=1))
+        self.assertEqual(len(self.q._heap), n // 2 - 1)
+
+        # Cancelling after compaction still works, and order is kept
+        evs[-1].cancel()
+        self.assertEqual(self.q.stats(), dict(live=n // 2 - 2, dead=1, compactions=1))
+        due = self.pop_due(float(n))
+        self.assertEqual([ev[3][0] for ev in due], list(range(n // 2 + 1, n - 1)))
+        self.assertEqual(self.q.stats(), dict(live=0, dead=0, compactions=1))
+
+    def test_cancel_after_pop(self):
+        ev = self.q.push(1.0, _f, (), {})
+        other = self.q.push(2.0, _f, (), {})
+        (popped,) = self.pop_due(1.0)
+        self.assertIs(popped, ev)
+        ev.cancel()  # Pulled off the heap; must not count as a tombstone
+        self.assertTrue(ev.cancelled)
+        self.assertEqual(self.q.stats(), dict(live=1, dead=0, compactions=0))
+        self.assertEqual(self.pop_due(2.0), [other])
+
+    def test_cancel_unscheduled(self):
+        ev = self.q.new(1.0, _f, (), {})
+        ev.cancel()
+        self.assertTrue(ev.cancelled)
+        self.assertEqual(self.q.stats(), dict(live=0, dead=0, compactions=0))
+        self.assertEqual(len(self.q), 0)
+
+
+class Recorder(basics.BasicHost):
+    """A host which remembers when it got each Ping"""
+
+    ENABLE_DISCOVERY = False
+
+    def __init__(self):
+        self.got = []
+
+    def handle_rx(self, packet, port):
+        if isinstance(packet, basics.Ping):
+            self.got.append((api.current_time(), packet.data))
+
+
+def _pinging_world(seed):
+    """
+    Makes a World with a host pinging another over a lossy link
+
+    Returns the World and the receiving host.
+    """
+    w = core.World()
+    w.simulation.rng.seed(seed)
+    a = basics.BasicHost.create("a")
+    b = Recorder.create("b")
+    a.linkTo(b, (UnreliableCable(drop=0.5), UnreliableCable(drop=0.5)))
+    count = [0]
+
+    def ping():
+        count[0] += 1
+        a.ping(b, data=count[0])
+
+    api.create_timer(0.25, ping)
+    return w, b
+
+
+class TestVirtualTime(unittest.TestCase):
+    def test_run_until_stops_at_time(self):
+        w = core.World()
+        ran = []
+        for t in (1, 2, 3):
+            w.doLater(t, lambda t=t: ran.append((t, w.time)))
+        w.run_until(2)
+        self.assertEqual(ran, [(1, 1), (2, 2)])
+        self.assertEqual(w.time, 2)
+        w.run_until(2.5)
+        self.assertEqual(len(ran), 2)
+        self.assertEqual(w.time, 2.5)
+        w.run_until(10)
+        self.assertEqual(ran[2:], [(3, 3)])
+        self.assertEqual(w.time, 10)
+
+    def test_run_until_runs_what_events_schedule(self):
+        w = core.World()
+        ran = []
+
+        def tick():
+            ran.append(w.time)
+            w.doLater(1, tick)
+
+        w.doLater(0, tick)
+        w.run_until(4.5)
+        self.assertEqual(ran, [0, 1, 2, 3, 4])
+
+    def test_no_wall_clock_sleep(self):
+        w = core.World()
+        ran = []
+        w.doLater(3600, lambda: ran.append(w.time))
+        w.doLater(86400, w.stop)
+        start = time.time()
+        w.start(threaded=False)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ran, [3600])
+        self.assertEqual(w.time, 86400)
+        self.assertTrue(w.ended)
+
+    def test_timers_in_virtual_time(self):
+        w = core.World()
+        ran = []
+        api.create_timer(5, lambda: ran.append(api.current_time()))
+        start = time.time()
+        w.run_until(3600)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ran, [5.0 * i for i in range(1, 721)])
+
+    def test_deterministic_with_seed(self):
+        results = []
+        for seed in (1, 1, 2):
+            w, b = _pinging_world(seed)
+            w.run_until(50)
+            results.append(b.got)
+        self.assertEqual(results[0], results[1])
+        self.assertNotEqual(results[0], results[2])
+        self.assertTrue(0 < len(results[0]) < 200)
+
+
+class TestMultipleWorlds(unittest.TestCase):
+    def test_interleaved_worlds_stay_isolated(self):
+        alone = []
+        for seed in (1, 2):
+            w, b = _pinging_world(seed)
+            w.run_until(50)
+            alone.append(b.got)
+
+        worlds = [_pinging_world(1), _pinging_world(2)]
+        seen = {0: [], 1: []}  # World -> (world, a, draw) at each check
+
+        for i, (w, b) in enumerate(worlds):
+            a = w.simulation.names["a"]
+
+            def check(i=i, w=w, a=a):
+                seen[i].append((core.world is w, core._builtin.get("a") is a))
+                seen[i].append(core.rand())
+
+            w.simulation.activate()  # So the timer goes in this World
+            api.create_timer(1, check)
+
+        for t in range(1, 51):
+            for w, b in worlds:
+                w.run_until(t)
+
+        self.assertEqual([b.got for w, b in worlds], alone)
+        for i in (0, 1):
+            checks = seen[i][0::2]
+            self.assertEqual(len(checks), 50)
+            self.assertTrue(all(c == (True, True) for c in checks), i)
+        self.assertNotEqual(seen[0][1::2], seen[1][1::2])
+
+        # Each World's names are its own, and only the current one's are
+        # builtins.
+        (w1, b1), (w2, b2) = worlds
+        self.assertIsNot(w1.simulation.names["b"], w2.simulation.names["b"])
+        self.assertIs(core.current, w2.simulation)
+        self.assertIs(core._builtin["b"], b2)
+        w1.simulation.activate()
+        self.assertIs(core._builtin["b"], b1)
+        self.assertIs(core._getEntByName("b"), b1)
+
+    def test_same_seed_same_draws_when_interleaved(self):
+        draws = {}
+
+        def make(key, seed):
+            w = core.World()
+            w.simulation.rng.seed(seed)
+            draws[key] = []
+            api.create_timer(1, lambda: draws[key].append(core.rand()))
+            return w
+
+        alone = make("alone", 7)
+        alone.run_until(20)
+        w1 = make(1, 7)
+        w2 = make(2, 8)
+        for t in range(1, 21):
+            w2.run_until(t)
+            w1.run_until(t)
+        self.assertEqual(draws[1], draws["alone"])
+        self.assertNotEqual(draws[2], draws[1])
+
+
+class TestBatchDispatch(unittest.TestCase):
+    def test_cancelled_by_earlier_event_in_same_batch(self):
+        w = core.World()
+        ran = []
+        events = []
+
+        def first():
+            ran.append("first")
+            events[1].cancel()
+
+        events.append(w.doLater(1, first))
+        events.append(w.doLater(1, lambda: ran.append("cancelled")))
+        events.append(w.doLater(1, lambda: ran.append("third")))
+        w.run_until(0)
+        with w.queue.cv:
+            due = w.queue.pop_due(1)
+        self.assertEqual(due, events)  # All in one batch
+        w._dispatch_batch(due)
+        self.assertEqual(ran, ["first", "third"])
+        self.assertTrue(events[1].cancelled)
+
+    def test_cancelled_in_same_batch_by_run_loop(self):
+        w = core.World()
+        ran = []
+        events = []
+
+        def first():
+            ran.append("first")
+            events[1].cancel()
+
+        events.append(w.doLater(1, first))
+        events.append(w.doLater(1, lambda: ran.append("cancelled")))
+        w.doLater(2, w.stop)
+        w.start(threaded=False)
+        self.assertEqual(ran, ["first"])
+
+    def test_same_time_events_scheduled_in_batch_run_after(self):
+        w = core.World()
+        ran = []
+
+        def first():
+            ran.append("first")
+            w.doLater(0, lambda: ran.append("scheduled by first"))
+
+        w.doLater(1, first)
+        w.doLater(1, lambda: ran.append("second"))
+        w.run_until(1)
+        self.assertEqual(ran, ["first", "second", "scheduled by first"])
+
+
+def _live(entity):
+    """Returns (entity's _live_ports, what they should be)"""
+    te = core.topoOf(entity)
+    return te._live_ports, [i for i, c in enumerate(te.ports) if c is not None]
+
+
+class TestLivePorts(unittest.TestCase):
+    def setUp(self):
+        self.w = core.World()
+        self.a = Recorder.create("a")
+        self.others = [Recorder.create("h%s" % (i,)) for i in range(4)]
+        for h in self.others:
+            self.a.linkTo(h)
+        self.w.run_until(1)
+
+    def unlink(self, a, b):
+        a.unlinkTo(b)  # Takes down both ends
+        self.w.run_until(self.w.time + 1)
+
+    def check(self, *entities):
+        for e in entities:
+            live, expected = _live(e)
+            self.assertEqual(live, expected, e.name)
+
+    def test_unlink_and_relink_same_port(self):
+        a, h = self.a, self.others
+        self.check(a, *h)
+        self.assertEqual(_live(a)[0], [0, 1, 2, 3])
+
+        self.unlink(a, h[1])
+        self.check(a, h[1])
+        self.assertEqual(_live(a)[0], [0, 2, 3])
+        self.assertEqual(_live(h[1])[0], [])
+
+        self.assertEqual(a.linkTo(h[1]), (1, 0))  # Back on the same ports
+        self.check(a, h[1])
+        self.assertEqual(_live(a)[0], [0, 1, 2, 3])
+
+        self.unlink(a, h[3])  # The last port
+        self.unlink(a, h[0])  # The first port
+        self.check(a, h[0], h[3])
+        self.assertEqual(_live(a)[0], [1, 2])
+        self.assertEqual(a.linkTo(h[3]), (0, 0))
+        self.check(a, h[3])
+
+    def test_disconnect(self):
+        a, h = self.a, self.others
+        h[2].linkTo(h[3])
+        self.w.run_until(2)
+        h[2].disconnect()
+        self.w.run_until(3)
+        self.check(h[2])
+        self.assertEqual(_live(h[2])[0], [])
+        self.check(a, h[3])
+        self.assertEqual(_live(a)[0], [0, 1, 3])
+        self.assertEqual(_live(h[3])[0], [0])
+
+        a.disconnect()
+        self.w.run_until(4)
+        self.check(a, *h)
+        self.assertEqual(_live(a)[0], [])
+        self.assertEqual(a.linkTo(h[0]), (0, 0))
+        self.check(a, h[0])
+
+    def test_flood_reaches_live_ports(self):
+        a, h = self.a, self.others
+        self.unlink(a, h[1])
+        extra = Recorder.create("extra")
+        a.linkTo(extra)  # Fills port 1 again
+        a.linkTo(h[1])  # On a new port
+        self.w.run_until(self.w.time + 1)
+        self.check(a)
+
+        t = self.w.time
+        self.w.doLater(1, a.send, basics.Ping(None, data="all"), flood=True)
+        self.w.doLater(2, a.send, basics.Ping(None, data="not 2"), port=2, flood=True)
+        self.w.run_until(t + 5)
+        got = dict((e.name, [d for _, d in e.got]) for e in h + [extra])
+        self.assertEqual(
+            got,
+            {
+                "h0": ["all", "not 2"],
+                "h1": ["all", "not 2"],
+                "h2": ["all"],
+                "h3": ["all", "not 2"],
+                "extra": ["all", "not 2"],
+            },
+        )
+
+
+class EventRecorder(object):
+    """An event interface which remembers what it was told"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kw: self.calls.append(name)
+
+
+class TestHeadless(unittest.TestCase):
+    def make_world(self, headless):
+        w = core.World(headless=headless)
+        w.simulation.events = w.gui = EventRecorder()
+        w.simulation.activate()
+        a = basics.BasicHost.create("a")
+        b = Recorder.create("b")
+        a.linkTo(b)
+        w.doLater(1, a.ping, b)
+        w.doLater(2, a.log, "hello", level="warning")
+        return w
+
+    def test_per_world(self):
+        gui = self.make_world(False)
+        headless = self.make_world(True)  # Made later, but mustn't affect gui
+        gui2 = self.make_world(False)
+        for w in (gui, headless, gui2):
+            w.run_until(10)
+        self.assertEqual(headless.gui.calls, [])
+        for w in (gui, gui2):
+            calls = set(w.gui.calls)
+            for name in ("send_entity_up", "send_link_up", "packet", "send_log"):
+                self.assertIn(name, calls)
+            te = w.simulation.topo[w.simulation.names["a"]]
+            self.assertTrue(te.gui_events)
+            self.assertTrue(te.ports[0].gui_events)
+        te = headless.simulation.topo[headless.simulation.names["a"]]
+        self.assertFalse(te.gui_events)
+        self.assertFalse(te.ports[0].gui_events)
+
+    def test_default_from_config(self):
+        self.assertFalse(core.World().gui_events)  # tests/ runs headless
+
+
+class LinkLogger(basics.BasicHost):
+    """A host which logs its link ups to the list in .log"""
+
+    ENABLE_DISCOVERY = False
+    log = None
+
+    def handle_link_up(self, port, latency):
+        self.log.append((self.name, port, latency))
+
+
+class TestLinkMany(unittest.TestCase):
+    def setup_world(self):
+        """
+        Makes a World with some hosts that already have links
+
+        h0 has a hole in its ports (where h2 was), so new links fill it.
+        """
+        core.World()
+        log = []
+        hosts = [LinkLogger.create("h%s" % (i,)) for i in range(5)]
+        for h in hosts:
+            h.log = log
+        for other in hosts[1:4]:
+            hosts[0].linkTo(other)
+        core.world.run_until(1)
+        hosts[0].unlinkTo(hosts[2])
+        hosts[2].unlinkTo(hosts[0])
+        core.world.run_until(2)
+        del log[:]
+        return hosts, log
+
+    def describe(self, hosts):
+        """The cable on each port of each host, as something comparable"""
+        return [
+            [
+                (
+                    None
+                    if c is None
+                    else (type(c), c.dst.entity.name, c.dstPort, c.latency)
+                )
+                for c in core.topoOf(h).ports
+            ]
+            for h in hosts
+        ]
+
+    def check(self, edges, latencies, cable):
+        results = []
+        for bulk in (False, True):
+            hosts, log = self.setup_world()
+            pairs = [(hosts[a], hosts[b]) for a, b in edges]
+            if bulk:
+                ports = api.link_many(pairs, latencies, cable)
+            else:
+                ports = [
+                    a.linkTo(b, cable, fillEmpty=True, latency=latency)
+                    for (a, b), latency in zip(pairs, latencies)
+                ]
+            core.world.run_until(3)
+            live = [list(core.topoOf(h)._live_ports) for h in hosts]
+            results.append((ports, self.describe(hosts), log, live))
+        self.assertEqual(results[1], results[0])
+        return results[0]
+
+    def test_same_as_link_to(self):
+        edges = [(0, 4), (0, 1), (4, 1), (2, 3), (0, 2), (3, 4), (2, 4)]
+        latencies = [0.5, None, 1, 2, 0.25, None, 3]
+        ports, _, log, _ = self.check(edges, latencies, None)
+        self.assertEqual(ports[0], (1, 0))  # Filled h0's hole
+        self.assertEqual(len(log), 2 * len(edges))
+
+    def test_half_specified_cable(self):
+        edges = [(0, 4), (1, 4), (4, 2), (0, 2), (3, 4)]
+        latencies = [0.5, None, 1, 2, None]
+        ports, _, log, _ = self.check(edges, latencies, (BasicCable, None))
+        # Only a's end is plugged in, so b's free port gets used again
+        self.assertEqual([p[1] for p in ports[:2]], [0, 0])
+        self.assertEqual(len(log), len(edges))
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_shared_slots(self):
+        w = core.World()
+        ran = []
+        for i in range(100):
+            api.create_timer(2, lambda i=i: ran.append((w.time, i)))
+        self.assertEqual(len(w.timers), 1)
+        w.run_until(4)
+        self.assertEqual(ran, [(t, i) for t in (2, 4) for i in range(100)])
+        self.assertEqual(len(w.queue), 1)
+
+    def test_cancel(self):
+        w = core.World()
+        ran = []
+        t1 = api.create_timer(1, lambda: ran.append(1))
+        t2 = api.create_timer(1, lambda: ran.append(2))
+        w.run_until(1)
+        t1.cancel()
+        w.run_until(3)
+        self.assertEqual(ran, [1, 2, 2, 2])
+        t2.cancel()
+        self.assertEqual(len(w.timers), 0)
+        self.assertEqual(len(w.queue), 0)
+
+    def test_cancel_later_timer_in_same_slot(self):
+        w = core.World()
+        ran = []
+        timers = []
+
+        def first():
+            ran.append("first")
+            timers[1].cancel()
+
+        timers.append(api.create_timer(1, first))
+        timers.append(api.create_timer(1, lambda: ran.append("second")))
+        w.run_until(2)
+        self.assertEqual(ran, ["first", "first"])
+
+    def test_remove_keeps_newer_slot_for_same_time(self):
+        w = core.World()
+        wheel = w.timers
+        ran = []
+        old = core.Timer(1, lambda: ran.append("old"))
+        (old_slot,) = wheel._slots.values()
+        # As while the slot is firing: it's out of _slots, and a timer added
+        # for the same time gets a new slot.
+        del wheel._slots[old_slot.key]
+        new = core.Timer(1, lambda: ran.append("new"))
+        self.assertIsNot(new._slot, old_slot)
+        old.cancel()
+        self.assertIs(wheel._slots.get(old_slot.key), new._slot)
+        w.run_until(1)
+        self.assertEqual(ran, ["new"])
+
+    def test_timers_from_other_thread(self):
+        w = core.World()
+        fired = []
+        api.create_timer(0.001, lambda: None)  # Keeps the clock moving
+        w.start()
+        try:
+            timers = []
+
+            def once(timer, i):
+                fired.append(i)
+                timer.cancel()
+
+            for i in range(2000):
+                timers.append(core.Timer(0, once, args=(i,), passSelf=True))
+                if i % 3 == 0:
+                    timers[-1].cancel()
+            expected = 2000 - len(range(0, 2000, 3))
+            deadline = time.time() + 10
+            while len(fired) < expected and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.05)  # In case anything fires twice
+        finally:
+            w.stop()
+            w._thread.join(5)
+        cancelled = set(range(0, 2000, 3))
+        fired_set = set(fired)
+        self.assertEqual(len(fired), len(fired_set))
+        self.assertEqual(fired_set | cancelled, set(range(2000)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import tests  # Sets up sim.config
+import sim.api as api
+import sim.basics as basics
+import sim.core as core
+from sim.cable import UnreliableCable
+
+
+class Receiver(basics.BasicHost):
+    """A host which remembers when it got each Ping"""
+
+    ENABLE_DISCOVERY = False
+
+    def __init__(self):
+        self.got = []
+
+    def handle_rx(self, packet, port):
+        if isinstance(packet, basics.Ping):
+            self.got.append((api.current_time(), packet.data))
+
+
+def _build(interval):
+    """
+    Sets up a host pinging another over a lossy link in the current World
+
+    The cables aren't given seeds, so they draw them from core.rand(), which
+    is what gets recorded.  Returns the receiving host.
+    """
+    a = basics.BasicHost.create("a")
+    b = Receiver.create("b")
+    a.linkTo(b, (UnreliableCable(0.05, drop=0.5), UnreliableCable(0.05, drop=0.5)))
+    count = [0]
+
+    def ping():
+        count[0] += 1
+        a.ping(b, data=count[0])
+
+    api.create_timer(interval, ping)
+    return b
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "run.rec")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def count_dispatches(self, replayer):
+        dispatched = []
+        inner = replayer._inner
+
+        def dispatch(o):
+            dispatched.append(o[0])
+            inner(o)
+
+        replayer._inner = dispatch
+        return dispatched
+
+    def record_virtual(self):
+        w = core.World()
+        recorder = w.record(self.filename)
+        b = _build(0.25)
+        w.run_until(20)
+        recorder.close()
+        return b.got
+
+    def test_virtual_time(self):
+        got = self.record_virtual()
+        self.assertTrue(0 < len(got) < 80)  # Some, but not all, were dropped
+
+        w = core.World()
+        replayer = w.replay(self.filename)
+        b = _build(0.25)
+        w.run_until(20)  # Raises ReplayDivergence if it diverges
+        self.assertEqual(b.got, got)
+        self.assertEqual(replayer._next_event, len(replayer.events))
+        self.assertEqual(replayer._next_draw, len(replayer.draws))
+
+    def test_replay_until(self):
+        self.record_virtual()
+        for n in (0, 1, 7, 50):
+            w = core.World()
+            replayer = w.replay(self.filename, until=n)
+            dispatched = self.count_dispatches(replayer)
+            _build(0.25)
+            w.run_until(20)
+            self.assertEqual(len(dispatched), n)
+            self.assertEqual(dispatched, [e[0] for e in replayer.events[:n]])
+
+    def test_real_time(self):
+        w = core.World()
+        w.virtual_time = False
+        recorder = w.record(self.filename)
+        b = _build(0.1)
+        w.start()
+        time.sleep(1)
+        w.stop()
+        w._thread.join()
+        recorder.close()
+        got = b.got
+        self.assertTrue(got)
+
+        # The replay runs in virtual time, but gets the same timestamps
+        w = core.World()
+        replayer = w.replay(self.filename)
+        dispatched = self.count_dispatches(replayer)
+        b = _build(0.1)
+        w.run_until(replayer.events[-1][1])  # Wall-clock times
+        self.assertEqual(b.got, got)
+        self.assertEqual(len(dispatched), len(replayer.events))
+
+        w = core.World()
+        replayer = w.replay(self.filename, until=10)
+        dispatched = self.count_dispatches(replayer)
+        _build(0.1)
+        w.run_until(replayer.events[-1][1])
+        self.assertEqual(len(dispatched), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
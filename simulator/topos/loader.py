@@ -1,4 +1,5 @@
 import sim
+import sim.api as api
 
 
 def launch(
@@ -68,12 +69,17 @@ def launch(
         elif t == "l":
             edges.append(rest)
 
+    links = []
+    latencies = []
     for rest in edges:
         rest = rest.split()
         assert len(rest) >= 2
-        extra = {}
+        latency = None
         if len(rest) == 3:
             # Latency
-            extra["latency"] = float(rest[2])
+            latency = float(rest[2])
         u, v = rest[:2]
-        get_node(u).linkTo(get_node(v), **extra)
+        links.append((get_node(u), get_node(v)))
+        latencies.append(latency)
+
+    api.link_many(links, latencies)
@@ -1,4 +1,5 @@
 import sim
+import sim.api as api
 import random
 
 
@@ -81,8 +82,7 @@ def launch(
     switches = []
     for i in range(n):
         switches.append(switch_type.create("s" + str(i + 1)))
-    for u, v in sorted(links):
-        switches[u].linkTo(switches[v])
+    edges = [(switches[u], switches[v]) for u, v in sorted(links)]
 
     for i in range(h):
         host = host_type.create("h" + str(i + 1))
@@ -91,4 +91,6 @@ def launch(
         if not multiple_hosts:
             switches.remove(switch)
 
-        switch.linkTo(host)
+        edges.append((switch, host))
+
+    api.link_many(edges)